@@ -1,18 +1,16 @@
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
+from aiogram import Dispatcher
 from aiogram import Router, types, F
 from aiogram.filters import Command
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
 
 from config import Config
 from models.database import db
-from utils.logging_utils import main_bot as MAIN_BOT
+from utils.broadcast import close_broadcasts, resume_broadcasts, start_broadcast
+from utils.logging_utils import log_shipper
+from utils.telegram_sender import close_shared_session, get_bot
 
 logging.basicConfig(level=logging.INFO)
 
@@ -37,6 +35,28 @@ class AdminStates(StatesGroup):
     broadcast_text = State()
     broadcast_confirm = State()
 
+async def _stats_text() -> str:
+    """Totals and the last 7 days from the incrementally maintained stats tables."""
+    totals, daily = await db.get_stats(days=7)
+    days: dict = {}
+    for row in daily:
+        days.setdefault(row['day'], {})[row['name']] = row['value']
+    lines = [
+        "<b>Статистика</b>\n",
+        f"Пользователей: {int(totals.get('users', 0))}",
+        f"Доход: ${totals.get('revenue_usd', 0)}",
+        f"Кристаллов продано: {int(totals.get('crystals_sold', 0))}",
+        f"Раскладов: {int(totals.get('spreads', 0))}",
+    ]
+    if days:
+        lines.append("\n<b>По дням</b> (новые / $ / 💎 / расклады)")
+        for day, v in sorted(days.items(), reverse=True):
+            lines.append(
+                f"{day:%d.%m}: {int(v.get('users', 0))} / ${v.get('revenue_usd', 0)} / "
+                f"{int(v.get('crystals_sold', 0))} / {int(v.get('spreads', 0))}"
+            )
+    return "\n".join(lines)
+
 @router.message(Command("start"))
 async def admin_start(message: types.Message):
     if not is_admin(message.from_user.id):
@@ -53,18 +73,7 @@ async def admin_stats_cb(callback: types.CallbackQuery):
     if not is_admin(callback.from_user.id):
         await callback.answer("Нет доступа", show_alert=True)
         return
-    async with db.pool.acquire() as conn:
-        users_count = await conn.fetchval("SELECT COUNT(*) FROM users")
-        transactions = await conn.fetch("SELECT SUM(amount_usd) as total_usd, SUM(amount_crystals) as total_crystals FROM transactions")
-        total_usd = transactions[0]['total_usd'] or 0
-        total_crystals = transactions[0]['total_crystals'] or 0
-    text = (
-        f"<b>Статистика</b>\n\n"
-        f"Пользователей: {users_count}\n"
-        f"Доход: ${total_usd}\n"
-        f"Кристаллов продано: {total_crystals}"
-    )
-    await callback.message.edit_text(text, reply_markup=admin_menu_kb())
+    await callback.message.edit_text(await _stats_text(), reply_markup=admin_menu_kb())
 
 @router.callback_query(F.data == "admin_grant")
 async def admin_grant_start(callback: types.CallbackQuery, state: FSMContext):
@@ -128,7 +137,7 @@ async def admin_find_query(message: types.Message, state: FSMContext):
         await message.reply("Отменено.", reply_markup=admin_menu_kb())
         return
     query = message.text.strip()
-    async with db.pool.acquire() as conn:
+    async with db.acquire("admin_find_user") as conn:
         if query.isdigit():
             user = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", int(query))
         else:
@@ -194,39 +203,14 @@ async def admin_broadcast_confirm(callback: types.CallbackQuery, state: FSMConte
         await callback.answer("Текст пуст или сессия устарела. Начни заново.", show_alert=True)
         return
     await state.clear()
-    async with db.pool.acquire() as conn:
-        users = await conn.fetch("SELECT user_id FROM users")
-
-    # Prefer reusing the main bot instance started in render_entry (so session is shared)
-    temp_bot: Bot | None = None
-    bot_to_use: Bot | None = MAIN_BOT
-    if bot_to_use is None:
-        # Fallback: create a temporary main bot client and make sure to close session afterwards
-        temp_bot = Bot(token=Config.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-        bot_to_use = temp_bot
-
-    # Telegram text limit is ~4096; chunk if needed
-    def _chunks(s: str, n: int = 4000):
-        for i in range(0, len(s), n):
-            yield s[i:i+n]
-
-    sent = 0
-    for user in users:
-        try:
-            for part in _chunks(text):
-                await bot_to_use.send_message(user['user_id'], part)
-            sent += 1
-        except Exception as e:
-            logging.error(f"Failed to send to {user['user_id']}: {e}")
-    try:
-        await callback.message.edit_text(f"Рассылка завершена. Отправлено: {sent}", reply_markup=admin_menu_kb())
-    finally:
-        if temp_bot is not None:
-            # Properly close temporary client session to avoid 'Unclosed client session'
-            try:
-                await temp_bot.session.close()
-            except Exception:
-                pass
+    await callback.answer("Рассылка запущена")
+    broadcast = await start_broadcast(
+        text,
+        reporter=callback.bot,
+        admin_chat_id=callback.message.chat.id,
+        progress_message_id=callback.message.message_id,
+    )
+    await callback.message.edit_text(broadcast.progress_text())
 
 @router.message(Command("menu"))
 async def admin_menu_cmd(message: types.Message):
@@ -249,19 +233,8 @@ async def cmd_stats(message: types.Message):
     if message.from_user.id not in Config.ADMIN_IDS:
         await message.reply("Доступ запрещен.")
         return
-    
-    async with db.pool.acquire() as conn:
-        users_count = await conn.fetchval("SELECT COUNT(*) FROM users")
-        transactions = await conn.fetch("SELECT SUM(amount_usd) as total_usd, SUM(amount_crystals) as total_crystals FROM transactions")
-        total_usd = transactions[0]['total_usd'] or 0
-        total_crystals = transactions[0]['total_crystals'] or 0
-    
-    text = f"Статистика:\n" \
-           f"Пользователей: {users_count}\n" \
-           f"Доход: ${total_usd}\n" \
-           f"Кристаллов продано: {total_crystals}"
-    
-    await message.reply(text)
+
+    await message.reply(await _stats_text())
 
 @router.message(Command("grant_crystals"))
 async def cmd_grant_crystals(message: types.Message):
@@ -296,7 +269,7 @@ async def cmd_find_user(message: types.Message):
         return
     
     query = args[1]
-    async with db.pool.acquire() as conn:
+    async with db.acquire("admin_find_user") as conn:
         if query.isdigit():
             user = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", int(query))
         else:
@@ -324,17 +297,13 @@ async def cmd_broadcast(message: types.Message):
         await message.reply("Укажите сообщение для рассылки.")
         return
     
-    async with db.pool.acquire() as conn:
-        users = await conn.fetch("SELECT user_id FROM users")
-
-    main_bot = Bot(token=Config.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    for user in users:
-        try:
-            await main_bot.send_message(user['user_id'], broadcast_text)
-        except Exception as e:
-            logging.error(f"Failed to send to {user['user_id']}: {e}")
-    
-    await message.reply("Рассылка завершена.")
+    progress = await message.reply("Рассылка запускается…")
+    await start_broadcast(
+        broadcast_text,
+        reporter=message.bot,
+        admin_chat_id=message.chat.id,
+        progress_message_id=progress.message_id,
+    )
 
 def get_admin_router() -> Router:
     """Expose admin router for reuse by other entrypoints."""
@@ -348,12 +317,16 @@ async def main():
     except Exception:
         pass
     # Create bot/dispatcher only when running this module standalone
-    bot = Bot(token=Config.ADMIN_BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot = get_bot(Config.ADMIN_BOT_TOKEN)
     dp = Dispatcher()
     dp.include_router(router)
+    await resume_broadcasts(reporter=bot)
     try:
-        await dp.start_polling(bot)
+        await dp.start_polling(bot, close_bot_session=False)
     finally:
+        await close_broadcasts()
+        await log_shipper.close()
+        await close_shared_session()
         try:
             await db.disconnect()
         except Exception:
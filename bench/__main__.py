@@ -0,0 +1,180 @@
+"""Load test: python -m bench --scenario free_card --users 500 --concurrency 100
+
+Drives the real Dispatcher (handlers, middlewares, Postgres FSM storage) and the
+admin router with synthetic updates. Telegram is a local fake Bot API server,
+Gemini and Stripe are stubs with configurable latency. Needs a Postgres that is
+safe to write to (BENCH_DATABASE_URL): the run creates users, payments and
+broadcasts there.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+
+SCENARIOS = ("free_card", "deep_dialog", "payment_storm", "broadcast")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--users", type=int, default=200, help="synthetic users (broadcast: recipients to seed)")
+    parser.add_argument("--concurrency", type=int, default=50, help="users running their flow at the same time")
+    parser.add_argument("--turns", type=int, default=10, help="answers per deep_dialog session")
+    parser.add_argument("--gemini-latency", default="lognormal:2.5:8", help="seconds: N, lognormal:MEDIAN:P95 or uniform:LOW:HIGH")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--stripe-latency", default="lognormal:0.4:1.2")
+    parser.add_argument("--telegram-latency", default="uniform:0.02:0.08")
+    parser.add_argument("--real-limits", action="store_true", help="keep production Telegram/broadcast rate limits")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"))
+    parser.add_argument("--json", dest="json_path", help="also write the results here")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("set BENCH_DATABASE_URL (or --database-url) to a database the benchmark may write to")
+    return args
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _configure_env(args, telegram_url: str, admin_id: int):
+    """Config reads the environment at import: point every external service at the fakes first."""
+    os.environ.update({
+        "DATABASE_URL": args.database_url,
+        "BOT_TOKEN": "100001:bench-main",
+        "ADMIN_BOT_TOKEN": "100002:bench-admin",
+        "ADMIN_IDS": str(admin_id),
+        "TELEGRAM_API_URL": telegram_url,
+        "GEMINI_API_KEY": "bench",
+        "GEMINI_PROMPT_CACHE": "0",
+        "STRIPE_SECRET_KEY": "sk_test_bench",
+        "STRIPE_WEBHOOK_SECRET": "whsec_bench",
+    })
+    os.environ.setdefault("CARD_READINGS", "0")
+    os.environ.setdefault("TRACE_SAMPLE_RATE", "0")
+    if not args.real_limits:
+        os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "100000")
+        os.environ.setdefault("TELEGRAM_CHAT_RATE", "100000")
+        os.environ.setdefault("TELEGRAM_CHAT_BURST", "100000")
+        os.environ.setdefault("BROADCAST_RATE_PER_SECOND", "100000")
+
+
+def _summary(bench, name: str, args, elapsed: float, updates: int, queries: int, api: dict, errors: list) -> dict:
+    from bench.harness import percentile
+
+    handlers = {
+        handler: {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p95_ms": round(percentile(values, 95) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+        }
+        for handler, values in sorted(bench.timings.items())
+    }
+    return {
+        "scenario": name,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "seconds": round(elapsed, 3),
+        "updates": updates,
+        "updates_per_second": round(updates / elapsed, 1) if elapsed else None,
+        "db_queries_per_update": round(queries / updates, 2) if updates else None,
+        "bot_api_requests_per_update": {m: round(n / updates, 2) for m, n in sorted(api.items())} if updates else {},
+        "gemini_calls": bench.gemini.calls,
+        "stripe_calls": bench.stripe.calls,
+        "errors": len(errors),
+        "handlers": handlers,
+    }
+
+
+def _print(result: dict):
+    print(f"\n== {result['scenario']}: {result['users']} users, concurrency {result['concurrency']}")
+    print(f"   {result['updates']} updates in {result['seconds']}s -> {result['updates_per_second']} updates/s, "
+          f"{result['db_queries_per_update']} DB queries/update, errors: {result['errors']}")
+    print(f"   Gemini calls: {result['gemini_calls']}, Stripe calls: {result['stripe_calls']}")
+    if result.get("messages_sent") is not None:
+        print(f"   broadcast: {result['messages_sent']} messages in {result['broadcast_seconds']}s -> {result['messages_per_second']} msg/s")
+    api = ", ".join(f"{m} {n}" for m, n in result["bot_api_requests_per_update"].items())
+    print(f"   Bot API requests/update: {api}")
+    print(f"   {'handler':<32}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for handler, h in result["handlers"].items():
+        print(f"   {handler:<32}{h['count']:>8}{h['p50_ms']:>10}{h['p95_ms']:>10}{h['p99_ms']:>10}")
+
+
+async def _run_scenario(bench, name: str, args, user_id_base: int) -> dict:
+    from bench import scenarios
+
+    bench.timings.clear()
+    bench.update_latency.clear()
+    bench.gemini.calls = bench.stripe.calls = 0
+    queries_before = bench.queries
+    api_before = dict(bench.telegram.requests)
+    errors = []
+    extra = {}
+    started = time.perf_counter()
+    if name == "broadcast":
+        extra = await scenarios.broadcast(bench, args.users, user_id_base)
+    else:
+        flow = scenarios.PER_USER[name]
+        slots = asyncio.Semaphore(args.concurrency)
+
+        async def one(i: int):
+            async with slots:
+                await flow(bench, user_id_base + i, args.turns)
+
+        results = await asyncio.gather(*(one(i) for i in range(args.users)), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        for error in errors[:3]:
+            logging.error(f"bench {name}: flow failed: {error!r}")
+    await bench.wait_background()
+    elapsed = time.perf_counter() - started
+    api = {m: n - api_before.get(m, 0) for m, n in bench.telegram.requests.items() if n - api_before.get(m, 0)}
+    result = _summary(bench, name, args, elapsed, len(bench.update_latency), bench.queries - queries_before, api, errors)
+    result.update(extra)
+    return result
+
+
+async def main():
+    args = _parse_args()
+    port = _free_port()
+    admin_id = 100_003
+    _configure_env(args, f"http://127.0.0.1:{port}", admin_id)
+
+    from bench.fake_telegram import FakeTelegram
+    from bench.harness import Bench
+    from bench.stubs import Latency, StubGemini, StubStripe
+
+    telegram = FakeTelegram(Latency(args.telegram_latency))
+    await telegram.start("127.0.0.1", port)
+    bench = Bench(
+        telegram,
+        StubGemini(Latency(args.gemini_latency), error_rate=args.gemini_error_rate),
+        StubStripe(Latency(args.stripe_latency)),
+        admin_id=admin_id,
+    )
+    await bench.setup()
+    # fresh user ids every run, so cooldowns and earlier runs do not interfere
+    user_id_base = int(time.time()) * 1000
+    results = []
+    try:
+        for name in SCENARIOS if args.scenario == "all" else (args.scenario,):
+            result = await _run_scenario(bench, name, args, user_id_base)
+            user_id_base += args.users
+            _print(result)
+            results.append(result)
+    finally:
+        await bench.close()
+        await telegram.close()
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main())
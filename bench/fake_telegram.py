@@ -0,0 +1,66 @@
+"""Local Bot API server answering every method the bot uses with a plausible result."""
+import asyncio
+import itertools
+import time
+from collections import Counter
+
+from aiohttp import web
+
+from bench.stubs import Latency
+
+_TRUE_METHODS = {"answercallbackquery", "sendchataction", "deletemessage", "setwebhook", "deletewebhook", "setmycommands"}
+
+
+class FakeTelegram:
+    """aiohttp app mounted at /bot<token>/<method>.
+
+    Message-returning methods get a fresh message_id; everything is counted per
+    method so the report can show Bot API calls per update.
+    """
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.requests: Counter[str] = Counter()
+        self._message_ids = itertools.count(1_000_000)
+        self._runner: web.AppRunner | None = None
+        self.url = ""
+
+    async def start(self, host: str, port: int):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.url = f"http://{host}:{port}"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.requests[method] += 1
+        params = dict(await request.post())
+        delay = self.latency.sample()
+        if delay:
+            await asyncio.sleep(delay)
+        return web.json_response({"ok": True, "result": self._result(method.lower(), params, request.match_info["token"])})
+
+    def _result(self, method: str, params: dict, token: str):
+        if method == "getme":
+            bot_id = int(token.split(":")[0])
+            return {"id": bot_id, "is_bot": True, "first_name": "Bench", "username": f"bench_{bot_id}_bot"}
+        if method in _TRUE_METHODS or (method == "editmessagereplymarkup" and "inline_message_id" in params):
+            return True
+        if method.startswith(("send", "edit")):
+            chat_id = int(params.get("chat_id", 0))
+            message_id = int(params["message_id"]) if method.startswith("edit") and "message_id" in params else next(self._message_ids)
+            return {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": int(token.split(":")[0]), "is_bot": True, "first_name": "Bench"},
+                "text": params.get("text", ""),
+            }
+        return True
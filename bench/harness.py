@@ -0,0 +1,172 @@
+"""Wires the real dispatchers to the fake Bot API, stub Gemini/Stripe and a local Postgres.
+
+Imported only after bench.__main__ has set the environment, since Config reads it at import.
+"""
+import asyncio
+import itertools
+import math
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable
+
+import asyncpg
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject, Update
+
+from admin_bot import get_admin_router
+from config import Config
+from handlers import register_handlers
+from handlers.stripe_webhook import handle_webhook
+from middlewares import register_middlewares
+from models.database import db
+from models.fsm_storage import create_fsm_storage
+from utils import gemini_utils
+from utils.active_messages import active_messages
+from utils.broadcast import close_broadcasts
+from utils.logging_utils import set_main_bot
+from utils.telegram_sender import close_shared_session, get_bot
+
+from bench.fake_telegram import FakeTelegram
+from bench.stubs import StubGemini, StubStripe
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class HandlerTimer(BaseMiddleware):
+    """Inner middleware keeping every handler duration (the metrics histograms are too coarse for p99)."""
+
+    def __init__(self, timings: dict[str, list[float]]):
+        self.timings = timings
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        name = getattr(getattr(data.get("handler"), "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.timings[name].append(time.perf_counter() - started)
+
+
+class _StripeRequest:
+    """The part of aiohttp's Request that handle_webhook uses."""
+
+    def __init__(self, payload: bytes):
+        self._payload = payload
+        self.headers = {"Stripe-Signature": "bench"}
+
+    async def read(self) -> bytes:
+        return self._payload
+
+
+class Bench:
+    def __init__(self, telegram: FakeTelegram, gemini: StubGemini, stripe: StubStripe, admin_id: int):
+        self.telegram = telegram
+        self.gemini = gemini
+        self.stripe = stripe
+        self.admin_id = admin_id
+        self.timings: dict[str, list[float]] = defaultdict(list)
+        self.update_latency: list[float] = []
+        self.queries = 0
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _count_query(self, record):
+        self.queries += 1
+
+    async def _init_connection(self, conn):
+        conn.add_query_logger(self._count_query)
+
+    def _timed(self, dp: Dispatcher) -> Dispatcher:
+        timer = HandlerTimer(self.timings)
+        dp.message.middleware(timer)
+        dp.callback_query.middleware(timer)
+        return dp
+
+    async def setup(self):
+        db.pool = await asyncpg.create_pool(
+            dsn=Config.DATABASE_URL,
+            min_size=Config.DB_POOL_MIN,
+            max_size=Config.DB_POOL_MAX,
+            init=self._init_connection,
+        )
+        await db.create_tables()
+        gemini_utils.client = self.gemini
+        self.stripe.install()
+
+        self.bot = get_bot(Config.BOT_TOKEN)
+        self.admin_bot = get_bot(Config.ADMIN_BOT_TOKEN)
+        set_main_bot(self.bot)
+        # Same wiring as render_entry.py: the admin dispatcher has no extra middlewares
+        self.dp = self._timed(Dispatcher(storage=create_fsm_storage()))
+        register_middlewares(self.dp)
+        register_handlers(self.dp)
+        self.admin_dp = self._timed(Dispatcher())
+        self.admin_dp.include_router(get_admin_router())
+
+    async def close(self):
+        await close_broadcasts()
+        await self.wait_background()
+        await active_messages.close()
+        await db.stats.close()
+        await close_shared_session()
+        await db.disconnect()
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"Bench{user_id}", "username": f"bench{user_id}"}
+
+    def _message(self, chat_id: int, sender: dict, text: str) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": sender,
+            "text": text,
+        }
+
+    async def _feed(self, dp: Dispatcher, bot, payload: dict):
+        payload["update_id"] = next(self._update_ids)
+        update = Update.model_validate(payload, context={"bot": bot})
+        started = time.perf_counter()
+        await dp.feed_update(bot, update)
+        self.update_latency.append(time.perf_counter() - started)
+
+    async def message(self, user_id: int, text: str, admin: bool = False):
+        dp, bot = (self.admin_dp, self.admin_bot) if admin else (self.dp, self.bot)
+        await self._feed(dp, bot, {"message": self._message(user_id, self._user(user_id), text)})
+
+    async def callback(self, user_id: int, data: str, admin: bool = False):
+        dp, bot = (self.admin_dp, self.admin_bot) if admin else (self.dp, self.bot)
+        bot_user = {"id": bot.id, "is_bot": True, "first_name": "Bench"}
+        await self._feed(dp, bot, {"callback_query": {
+            "id": str(next(self._update_ids)),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": self._message(user_id, bot_user, "…"),
+        }})
+
+    async def stripe_webhook(self, session_id: str):
+        started = time.perf_counter()
+        try:
+            await handle_webhook(_StripeRequest(self.stripe.completed_event(session_id)))
+        finally:
+            self.timings["stripe:handle_webhook"].append(time.perf_counter() - started)
+
+    async def wait_background(self):
+        """Let write-behind buffers (FSM, active messages, stats) reach the database."""
+        for dp in (self.dp, self.admin_dp):
+            flush = getattr(dp.storage, "flush", None)
+            if flush is not None:
+                await flush()
+        await active_messages.flush()
+        await db.stats.flush()
+        await asyncio.sleep(0)
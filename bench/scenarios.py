@@ -0,0 +1,69 @@
+"""Benchmark scenarios. Per-user flows run once per synthetic user; `broadcast` runs once."""
+import asyncio
+
+from config import Config
+from models.database import db
+from utils import broadcast as broadcast_engine
+
+from bench.harness import Bench
+
+PER_USER = {}
+
+
+def per_user(name: str):
+    def register(flow):
+        PER_USER[name] = flow
+        return flow
+    return register
+
+
+@per_user("free_card")
+async def free_card(bench: Bench, user_id: int, turns: int):
+    await bench.message(user_id, "/start")
+    await bench.callback(user_id, "tarot_free")
+    await bench.message(user_id, "Что меня ждёт на новой работе?")
+    await bench.callback(user_id, "proceed_dialog")
+
+
+@per_user("deep_dialog")
+async def deep_dialog(bench: Bench, user_id: int, turns: int):
+    """Paid deep spread followed by a dialog of `turns` answers in total."""
+    await bench.message(user_id, "/start")
+    await db.update_balance(user_id, Config.TAROT_DEEP_COST)
+    await bench.callback(user_id, "tarot_deep")
+    await bench.callback(user_id, "confirm_spend:tarot_deep")
+    await bench.message(user_id, "Как мне наладить отношения с братом?")
+    await bench.callback(user_id, "proceed_dialog")
+    for turn in range(1, turns):
+        await bench.message(user_id, f"А что значит карта номер {turn} в этом раскладе?")
+
+
+@per_user("payment_storm")
+async def payment_storm(bench: Bench, user_id: int, turns: int):
+    await bench.message(user_id, "/start")
+    await bench.callback(user_id, "buy_crystals")
+    await bench.callback(user_id, "buy_standard")
+    session_id = bench.stripe.by_user[user_id]
+    # Stripe delivers at least once: send the same event twice concurrently
+    await asyncio.gather(bench.stripe_webhook(session_id), bench.stripe_webhook(session_id))
+
+
+async def broadcast(bench: Bench, recipients: int, user_id_base: int) -> dict:
+    """Seed `recipients` users, start a broadcast through the admin dispatcher and wait for it to finish."""
+    async with db.acquire("bench_seed") as conn:
+        await conn.execute(
+            "INSERT INTO users (user_id, username) SELECT g, 'bench' || g "
+            "FROM generate_series($1::bigint, $2::bigint) AS g ON CONFLICT (user_id) DO NOTHING",
+            user_id_base, user_id_base + recipients - 1,
+        )
+    sent_before = bench.telegram.requests["sendMessage"]
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    await bench.callback(bench.admin_id, "admin_broadcast", admin=True)
+    await bench.message(bench.admin_id, "Бенчмарк рассылки: это сообщение можно игнорировать.", admin=True)
+    await bench.callback(bench.admin_id, "broadcast_confirm", admin=True)
+    while broadcast_engine._tasks:
+        await asyncio.gather(*list(broadcast_engine._tasks.values()), return_exceptions=True)
+    elapsed = loop.time() - started
+    sent = bench.telegram.requests["sendMessage"] - sent_before
+    return {"messages_sent": sent, "broadcast_seconds": round(elapsed, 3), "messages_per_second": round(sent / elapsed, 1) if elapsed else None}
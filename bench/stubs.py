@@ -0,0 +1,150 @@
+"""Stand-ins for Gemini and Stripe with configurable latency, installed by monkeypatching."""
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from types import SimpleNamespace
+
+_ANSWER = (
+    "**Твой вопрос** — о том, куда направить силы.\n\n"
+    "- *Карта 1* говорит о начале пути.\n- *Карта 2* — о сомнениях.\n\n"
+    "Наблюдение: ты уже знаешь ответ. Вопрос к себе: что мешает начать? Шаг: запиши одну цель."
+)
+
+
+class Latency:
+    """Latency distribution in seconds, parsed from a spec:
+
+    - `0.2` — fixed
+    - `lognormal:MEDIAN:P95` — long-tailed, typical for LLM calls
+    - `uniform:LOW:HIGH`
+    """
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, _, args = spec.partition(":")
+        if not args:
+            self._sample = lambda value=float(kind): value
+            return
+        a, b = (float(x) for x in args.split(":"))
+        if kind == "lognormal":
+            sigma = math.log(b / a) / 1.645 if b > a else 0.0
+            self._sample = lambda: random.lognormvariate(math.log(a), sigma)
+        elif kind == "uniform":
+            self._sample = lambda: random.uniform(a, b)
+        else:
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self) -> float:
+        return self._sample()
+
+    def __str__(self):
+        return self.spec
+
+
+def _usage(prompt: str, answer: str):
+    prompt_tokens = len(prompt) // 4
+    output_tokens = len(answer) // 4
+    return SimpleNamespace(
+        prompt_token_count=prompt_tokens,
+        cached_content_token_count=0,
+        candidates_token_count=output_tokens,
+        total_token_count=prompt_tokens + output_tokens,
+    )
+
+
+class StubGemini:
+    """Drop-in for `genai.Client` as used by utils.gemini_utils (models, aio.models)."""
+
+    def __init__(self, latency: Latency, error_rate: float = 0.0, stream_chunks: int = 8):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stream_chunks = stream_chunks
+        self.calls = 0
+        self.models = SimpleNamespace(generate_content=self._generate_sync)
+        self.aio = SimpleNamespace(models=SimpleNamespace(
+            generate_content=self._generate,
+            generate_content_stream=self._generate_stream,
+        ))
+
+    def _maybe_fail(self):
+        if random.random() < self.error_rate:
+            raise RuntimeError("503 UNAVAILABLE (stub)")
+
+    def _generate_sync(self, model, contents, config=None):
+        self.calls += 1
+        time.sleep(self.latency.sample())
+        self._maybe_fail()
+        return SimpleNamespace(text=_ANSWER, candidates=[], usage_metadata=_usage(str(contents), _ANSWER))
+
+    async def _generate(self, model, contents, config=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency.sample())
+        self._maybe_fail()
+        return SimpleNamespace(text=_ANSWER, candidates=[], usage_metadata=_usage(str(contents), _ANSWER))
+
+    async def _generate_stream(self, model, contents, config=None):
+        self.calls += 1
+        total = self.latency.sample()
+        self._maybe_fail()
+        step = math.ceil(len(_ANSWER) / self.stream_chunks)
+        pieces = [_ANSWER[i:i + step] for i in range(0, len(_ANSWER), step)]
+
+        async def chunks():
+            # first token after ~30% of the time, the rest spread evenly
+            await asyncio.sleep(total * 0.3)
+            for i, piece in enumerate(pieces):
+                if i:
+                    await asyncio.sleep(total * 0.7 / len(pieces))
+                last = i == len(pieces) - 1
+                yield SimpleNamespace(text=piece, candidates=[], usage_metadata=_usage(str(contents), _ANSWER) if last else None)
+
+        return chunks()
+
+
+class StubStripe:
+    """Replaces the Stripe calls made by the bot: Checkout Session create/retrieve and webhook verification."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.calls = 0
+        self.sessions: dict[str, dict] = {}
+        self.by_user: dict[int, str] = {}
+
+    def install(self):
+        import stripe
+
+        stripe.checkout.Session.create = self.create
+        stripe.checkout.Session.retrieve = self.retrieve
+        stripe.Webhook.construct_event = lambda payload, sig_header, secret: json.loads(payload)
+
+    def create(self, **params):
+        self.calls += 1
+        time.sleep(self.latency.sample())
+        session_id = f"cs_bench_{uuid.uuid4().hex}"
+        amount = params["line_items"][0]["price_data"]["unit_amount"]
+        session = {
+            "id": session_id,
+            "url": f"https://checkout.stripe.test/{session_id}",
+            "metadata": params["metadata"],
+            "amount_total": amount,
+            "payment_status": "paid",
+            "payment_intent": f"pi_bench_{uuid.uuid4().hex}",
+        }
+        self.sessions[session_id] = session
+        self.by_user[int(params["metadata"]["user_id"])] = session_id
+        return SimpleNamespace(**session)
+
+    def retrieve(self, session_id):
+        self.calls += 1
+        time.sleep(self.latency.sample())
+        return self.sessions[session_id]
+
+    def completed_event(self, session_id: str) -> bytes:
+        return json.dumps({
+            "id": f"evt_{uuid.uuid4().hex}",
+            "type": "checkout.session.completed",
+            "data": {"object": self.sessions[session_id]},
+        }).encode()
@@ -1,18 +1,15 @@
 from aiogram import Router, types, F
 from datetime import datetime, timedelta
-import stripe
 import logging
 import uuid
 
 from utils.ui import set_active_kb
 from utils.logging_utils import log_payment
-from utils.stripe_utils import create_checkout_session
+from utils.stripe_utils import create_checkout_session, retrieve_checkout_session
 from utils.ui import crystals_menu_kb, main_menu_kb
 from models.database import db
 from config import Config
 
-stripe.api_key = Config.STRIPE_SECRET_KEY
-
 router = Router()
 
 @router.callback_query(F.data == "buy_crystals")
@@ -31,7 +28,7 @@ async def process_buy(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
     try:
-        checkout_url, crystals, session_id = create_checkout_session(
+        checkout_url, crystals, session_id = await create_checkout_session(
             user_id=user_id,
             package=package,
             chat_id=callback.message.chat.id,
@@ -75,16 +72,14 @@ async def verify_payment(callback: types.CallbackQuery):
                 await callback.answer("Сессия не найдена. Попробуй через пару секунд.", show_alert=False)
                 return
             session_id = mapped
-        session = stripe.checkout.Session.retrieve(session_id)
+        session = await retrieve_checkout_session(session_id)
         if session.get('payment_status') == 'paid':
             user_id = int(session['metadata']['user_id'])
             chat_id = int(session['metadata'].get('chat_id', user_id))
             crystals = int(session['metadata']['crystals'])
             amount_usd = session.get('amount_total', 0) / 100
             payment_intent = session.get('payment_intent')
-            if not await db.transaction_exists(payment_intent):
-                await db.update_balance(user_id, crystals)
-                await db.record_transaction(user_id, payment_intent, amount_usd, crystals)
+            credited_now = await db.credit_payment(user_id, payment_intent, amount_usd, crystals) is not None
             if not token_or_id.startswith("cs_"):
                 try:
                     await db.delete_checkout_session(token_or_id)
@@ -108,11 +103,12 @@ async def verify_payment(callback: types.CallbackQuery):
                 reply_markup=main_menu_kb(balance=balance_now, free_available=free_available),
             )
             await set_active_kb(callback.message)
-            try:
-                username = user['username'] if user and user.get('username') else str(user_id)
-                await log_payment(username, crystals, amount_usd)
-            except Exception as e:
-                logging.warning(f"Failed to log payment for user {user_id}: {e}")
+            if credited_now:
+                try:
+                    username = user['username'] if user and user.get('username') else str(user_id)
+                    await log_payment(username, crystals, amount_usd)
+                except Exception as e:
+                    logging.warning(f"Failed to log payment for user {user_id}: {e}")
         else:
             await callback.answer("Платёж ещё не подтверждён", show_alert=False)
     except Exception as e:
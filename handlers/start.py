@@ -18,11 +18,9 @@ async def cmd_start(message: types.Message):
 
     user = await db.get_user(user_id)
     if not user:
-        await db.create_user(user_id, username)
+        user = await db.create_user(user_id, username) or await db.get_user(user_id)
         await log_new_user(username or "Unknown", user_id)
 
-    user = await db.get_user(user_id)
-
     balance = user['balance_crystals'] if user else None
     free_available = True
     remaining_text = "доступна"
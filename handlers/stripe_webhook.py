@@ -1,4 +1,5 @@
 import aiohttp
+import asyncio
 import json
 import stripe
 from aiohttp import web
@@ -6,8 +7,13 @@ from datetime import datetime, timedelta
 import logging
 
 from models.database import db
-from utils.logging_utils import log_payment, main_bot
+from utils import logging_utils
+from utils.logging_utils import log_payment
+from utils.metrics import render as render_metrics
+from utils.telegram_sender import rate_limiter
 from utils.ui import main_menu_kb
+from utils.stripe_utils import retrieve_checkout_session
+from utils.telegram_webhook import setup_telegram_webhook
 from config import Config
 
 stripe.api_key = Config.STRIPE_SECRET_KEY
@@ -34,22 +40,17 @@ async def handle_webhook(request):
         amount_usd = session['amount_total'] / 100 
         
         payment_id = session['payment_intent']
-        if await db.transaction_exists(payment_id):
+        balance_now = await db.credit_payment(user_id, payment_id, amount_usd, crystals)
+        if balance_now is None:
             logging.info(f"Stripe webhook: transaction {payment_id} already recorded, skipping")
             return web.Response(status=200)
 
-        await db.update_balance(user_id, crystals)
-        
-
-        await db.record_transaction(user_id, payment_id, amount_usd, crystals)
-        
         user = await db.get_user(user_id)
-        await log_payment(user['username'] or str(user_id), crystals, amount_usd)
+        await log_payment((user['username'] if user else None) or str(user_id), crystals, amount_usd)
 
         try:
+            main_bot = logging_utils.main_bot
             if main_bot:
-                user = await db.get_user(user_id)
-                balance_now = user['balance_crystals'] if user else 0
                 free_available = True
                 if user and user['last_free_card_ts']:
                     try:
@@ -91,9 +92,18 @@ async def handle_webhook(request):
     
     return web.Response(status=200)
 
-async def start_webhook_server():
+async def start_webhook_server(dp=None, bot=None) -> web.AppRunner:
+    """Start the aiohttp server (Stripe webhook, payment pages, healthcheck).
+
+    When dp and bot are given and TELEGRAM_MODE=webhook, Telegram updates are
+    accepted on TELEGRAM_WEBHOOK_PATH of the same server. Returns the runner;
+    callers must `await runner.cleanup()` on shutdown so queued updates are drained.
+    """
     app = web.Application()
     app.router.add_post('/webhook', handle_webhook)
+    ingress = None
+    if dp is not None and bot is not None and Config.TELEGRAM_MODE == "webhook":
+        ingress = setup_telegram_webhook(app, dp, bot)
     def _success_html(credited: bool, crystals: int | None = None) -> str:
         cta_href = f"https://t.me/{Config.BOT_USERNAME}" if Config.BOT_USERNAME else "tg://resolve"
         status = "Оплата подтверждена" if credited else "Оплата успешно завершена"
@@ -170,17 +180,16 @@ async def start_webhook_server():
         crystals = None
         if session_id:
             try:
-                session = stripe.checkout.Session.retrieve(session_id)
+                session = await retrieve_checkout_session(session_id)
                 payment_intent = session.get('payment_intent')
                 if session.get('payment_status') == 'paid' and payment_intent:
                     user_id = int(session['metadata']['user_id'])
                     chat_id = int(session['metadata'].get('chat_id', user_id))
                     crystals = int(session['metadata']['crystals'])
                     amount_usd = session.get('amount_total', 0) / 100
-                    if not await db.transaction_exists(payment_intent):
-                        await db.update_balance(user_id, crystals)
-                        await db.record_transaction(user_id, payment_intent, amount_usd, crystals)
+                    if await db.credit_payment(user_id, payment_intent, amount_usd, crystals) is not None:
                         try:
+                            main_bot = logging_utils.main_bot
                             if main_bot:
                                 await main_bot.send_message(
                                     chat_id,
@@ -201,8 +210,32 @@ async def start_webhook_server():
         return web.Response(text=svg, content_type='image/svg+xml')
     app.router.add_get('/favicon.ico', handle_favicon)
     async def handle_health(request):
-        return web.Response(text="ok")
+        # Readiness: 503 unless the DB answers and Telegram updates are still flowing
+        checks = {}
+        try:
+            # The pool wait counts too: an exhausted pool must fail the probe, not hang it
+            async with asyncio.timeout(3):
+                async with db.acquire("healthz") as conn:
+                    await conn.fetchval("SELECT 1")
+            checks["db"] = "ok"
+        except Exception as e:
+            checks["db"] = f"error: {type(e).__name__}: {e}"
+        if ingress is not None:
+            checks["telegram"] = "ok" if ingress.alive() else "webhook workers are not running"
+        elif bot is not None:
+            age = rate_limiter.seconds_since_poll(bot.id)
+            if age is None:
+                checks["telegram"] = "no getUpdates yet"
+            elif age > Config.HEALTHZ_POLL_MAX_AGE_SECONDS:
+                checks["telegram"] = f"last getUpdates {age:.0f}s ago"
+            else:
+                checks["telegram"] = "ok"
+        ready = all(v == "ok" for v in checks.values())
+        return web.json_response({"status": "ok" if ready else "unavailable", "checks": checks}, status=200 if ready else 503)
     app.router.add_get('/healthz', handle_health)
+    async def handle_metrics(request):
+        return web.Response(body=render_metrics().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+    app.router.add_get('/metrics', handle_metrics)
     async def handle_root(request):
         cta_href = f"https://t.me/{Config.BOT_USERNAME}" if Config.BOT_USERNAME else None
         html = f"""
@@ -229,8 +262,10 @@ async def start_webhook_server():
                 <h1>Сервис Нить запущен ✅</h1>
                 <p>HTTP-сервер работает. Технические эндпоинты:</p>
                 <ul>
-                    <li><code>/healthz</code> — healthcheck</li>
+                    <li><code>/healthz</code> — readiness (БД и поступление апдейтов Telegram), 503 если не готов</li>
+                    <li><code>/metrics</code> — метрики в формате Prometheus</li>
                     <li><code>/webhook</code> — Stripe webhook (POST)</li>
+                    <li><code>{Config.TELEGRAM_WEBHOOK_PATH}</code> — Telegram webhook (POST, при <code>TELEGRAM_MODE=webhook</code>)</li>
                     <li><code>/success</code> и <code>/cancel</code> — страницы после оплаты</li>
                 </ul>
                 {f'<div class=\"cta\"><a class=\"btn\" href=\"{cta_href}\">Перейти в Telegram-бот</a></div>' if cta_href else ''}
@@ -247,6 +282,7 @@ async def start_webhook_server():
     site = web.TCPSite(runner, '0.0.0.0', port)
     await site.start()
     logging.info(f"Webhook server started on http://0.0.0.0:{port} (use PUBLIC_BASE_URL for external access)")
+    return runner
 
 if __name__ == "__main__":
     import asyncio
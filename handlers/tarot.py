@@ -9,9 +9,13 @@ import logging
 import re
 import html as _html
 
-from models.database import db
+from models.database import db, SPEND_USER_NOT_FOUND, SPEND_INSUFFICIENT_BALANCE, SPEND_FREE_CARD_COOLDOWN
 from utils.tarot_utils import draw_cards
-from utils.gemini_utils import generate_ai_response
+from utils.gemini_utils import generate_ai_response, stream_ai_response
+from utils.streaming import IncrementalRenderer, StreamingEditor
+from utils.history import fold_history
+from utils.card_readings import card_readings, classify_question
+from utils.tracing import traced
 from config import Config
 from utils.ui import (
     incognito_preset_kb,
@@ -28,6 +32,7 @@ _BOLD_RE = re.compile(r"\*\*(.+?)\*\*")
 _ITALIC_RE = re.compile(r"(?<!\*)\*(?!\*)(.+?)(?<!\*)\*(?!\*)")
 _CODE_RE = re.compile(r"`{1,3}([^`]+?)`{1,3}")
 
+@traced("render.md_to_html")
 def _md_to_safe_html(text: str) -> str:
     """Very small, conservative markdown→HTML for Telegram HTML parse mode.
     - Escapes all HTML first.
@@ -51,6 +56,44 @@ def _md_to_safe_html(text: str) -> str:
     s = re.sub(r"\n{3,}", "\n\n", s)
     return s
 
+async def _answer_with_ai(placeholder: types.Message, user_display_name, cards, question, history=None, spread=None, history_summary=None) -> tuple[str, types.Message]:
+    """Fill the "Готовлю ответ…" placeholder with the AI answer.
+
+    With AI_STREAMING the placeholder is edited progressively as tokens arrive.
+    `spread` enables the response cache (pass None in Incognito).
+    Returns the raw answer and the message that ended up holding it.
+    """
+    if Config.AI_STREAMING:
+        editor = StreamingEditor(placeholder, render=IncrementalRenderer(_md_to_safe_html))
+        try:
+            ai_response = await stream_ai_response(user_display_name, cards, question, history, on_text=editor.push, spread=spread, history_summary=history_summary)
+        except BaseException:
+            await editor.cancel()
+            raise
+        sent = await editor.finish(_md_to_safe_html(ai_response), reply_markup=end_dialog_kb())
+        return ai_response, sent
+
+    ai_response = await generate_ai_response(user_display_name, cards, question, history, spread=spread, history_summary=history_summary)
+    try:
+        await placeholder.edit_text(_md_to_safe_html(ai_response), reply_markup=end_dialog_kb(), parse_mode=ParseMode.HTML)
+        sent = placeholder
+    except Exception:
+        sent = await placeholder.answer(_md_to_safe_html(ai_response), reply_markup=end_dialog_kb(), parse_mode=ParseMode.HTML)
+    return ai_response, sent
+
+async def _answer_with_card_reading(placeholder: types.Message, card: str, question: str) -> tuple[str, types.Message] | None:
+    """Serve the Карта Дня answer from the pre-generated card_readings store, if there is one."""
+    reading = card_readings.get(card, classify_question(question))
+    if not reading:
+        return None
+    text = f"**{card}**\n\n{reading}"
+    try:
+        await placeholder.edit_text(_md_to_safe_html(text), reply_markup=end_dialog_kb(), parse_mode=ParseMode.HTML)
+        sent = placeholder
+    except Exception:
+        sent = await placeholder.answer(_md_to_safe_html(text), reply_markup=end_dialog_kb(), parse_mode=ParseMode.HTML)
+    return text, sent
+
 class TarotStates(StatesGroup):
     ask_question = State()
     selecting_options = State()
@@ -135,39 +178,35 @@ async def receive_question(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     user_display_name = getattr(message.from_user, 'first_name', None) or getattr(message.from_user, 'full_name', None) or message.from_user.username
     user_text = message.text.strip()
-    user = await db.get_user(user_id)
-    if not user:
-        await message.reply("Пользователь не найден.")
-        await state.clear()
-        return
     data = await state.get_data()
     action = data.get('selected_action')
     num_cards = data.get('num_cards', 1)
     cost = data.get('cost', 0)
 
-    if action == "tarot_free":
-        if user['last_free_card_ts'] and datetime.now() - user['last_free_card_ts'] < timedelta(hours=Config.FREE_CARD_COOLDOWN_HOURS):
-            kb = types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_main")]])
-            await message.reply("Карта Дня доступна раз в 24 часа.", reply_markup=kb)
-            await state.clear()
-            return
-    if cost > 0 and user['balance_crystals'] < cost:
+    cooldown = timedelta(hours=Config.FREE_CARD_COOLDOWN_HOURS) if action == "tarot_free" else None
+    _, reject_reason = await db.try_spend(user_id, cost, free_card_cooldown=cooldown)
+    if reject_reason == SPEND_USER_NOT_FOUND:
+        await message.reply("Пользователь не найден.")
+        await state.clear()
+        return
+    if reject_reason == SPEND_FREE_CARD_COOLDOWN:
+        kb = types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_main")]])
+        await message.reply("Карта Дня доступна раз в 24 часа.", reply_markup=kb)
+        await state.clear()
+        return
+    if reject_reason == SPEND_INSUFFICIENT_BALANCE:
+        user = await db.get_user(user_id)
         kb = types.InlineKeyboardMarkup(inline_keyboard=[
             [types.InlineKeyboardButton(text="💎 Купить кристаллы", callback_data="buy_crystals")],
             [types.InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_main")],
         ])
         await message.reply(
-            f"Недостаточно кристаллов. Нужно {cost} 💎, у тебя {user['balance_crystals']} 💎.",
+            f"Недостаточно кристаллов. Нужно {cost} 💎, у тебя {user['balance_crystals'] if user else 0} 💎.",
             reply_markup=kb
         )
         await state.clear()
         return
 
-    if cost > 0:
-        await db.update_balance(user_id, -cost)
-    if action == "tarot_free":
-        await db.set_last_free_card(user_id)
-
     await state.update_data(user_question=user_text)
 
     cards = draw_cards(num_cards)
@@ -213,14 +252,17 @@ async def proceed_dialog(callback: types.CallbackQuery, state: FSMContext):
     question = data.get('user_question', '')
     incognito = data.get('incognito', False)
     history = [] if incognito else data.get('message_history', [])
+    history_summary = None if incognito else data.get('history_summary')
     await callback.message.edit_reply_markup(reply_markup=incognito_preset_kb_disabled(incognito))
     await callback.message.bot.send_chat_action(chat_id=callback.message.chat.id, action=ChatAction.TYPING)
-    sent = await callback.message.answer("Готовлю ответ…")
-    ai_response = generate_ai_response(user_display_name, cards, question, history)
-    try:
-        await sent.edit_text(_md_to_safe_html(ai_response), reply_markup=end_dialog_kb(), parse_mode=ParseMode.HTML)
-    except Exception:
-        sent = await callback.message.answer(_md_to_safe_html(ai_response), reply_markup=end_dialog_kb(), parse_mode=ParseMode.HTML)
+    placeholder = await callback.message.answer("Готовлю ответ…")
+    served = None
+    if Config.CARD_READINGS and data.get('selected_action') == "tarot_free" and len(cards) == 1 and not history:
+        served = await _answer_with_card_reading(placeholder, cards[0], question)
+    if served is None:
+        spread = None if incognito else data.get('selected_action')
+        served = await _answer_with_ai(placeholder, user_display_name, cards, question, history, spread=spread, history_summary=history_summary)
+    ai_response, sent = served
     await set_active_kb(sent)
     try:
         await callback.message.edit_reply_markup(reply_markup=None)
@@ -229,7 +271,6 @@ async def proceed_dialog(callback: types.CallbackQuery, state: FSMContext):
             logging.warning(f"Failed to clear reply markup in proceed_dialog: {e}")
     except Exception as e:
         logging.warning(f"Failed to clear reply markup in proceed_dialog: {e}")
-    await state.update_data()
 
 @router.message(TarotStates.in_dialog, F.text)
 async def handle_dialog(message: types.Message, state: FSMContext):
@@ -255,24 +296,21 @@ async def handle_dialog(message: types.Message, state: FSMContext):
     
     await message.bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING)
     
+    placeholder = await message.answer("Готовлю ответ…")
     if not data.get('user_question'):
         await state.update_data(user_question=user_text)
-        ai_response = generate_ai_response(user_display_name, cards, user_text)
+        spread = None if incognito else data.get('selected_action')
+        ai_response, sent = await _answer_with_ai(placeholder, user_display_name, cards, user_text, spread=spread)
     else:
         if incognito:
-            ai_response = generate_ai_response(user_display_name, cards, data['user_question'], [])
+            ai_response, sent = await _answer_with_ai(placeholder, user_display_name, cards, data['user_question'], [])
         else:
             history.append({"role": "user", "content": user_text})
-            ai_response = generate_ai_response(user_display_name, cards, data['user_question'], history)
+            history_summary = data.get('history_summary')
+            ai_response, sent = await _answer_with_ai(placeholder, user_display_name, cards, data['user_question'], history, history_summary=history_summary)
             history.append({"role": "assistant", "content": ai_response})
-            await state.update_data(message_history=history)
-    
-    placeholder = await message.answer("Готовлю ответ…")
-    try:
-        await placeholder.edit_text(_md_to_safe_html(ai_response), reply_markup=end_dialog_kb(), parse_mode=ParseMode.HTML)
-        sent = placeholder
-    except Exception:
-        sent = await message.answer(_md_to_safe_html(ai_response), reply_markup=end_dialog_kb(), parse_mode=ParseMode.HTML)
+            history, history_summary = fold_history(history, history_summary)
+            await state.update_data(message_history=history, history_summary=history_summary)
     await set_active_kb(sent)
     await state.update_data(last_activity=now.isoformat())
 
@@ -1,33 +1,59 @@
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
+from aiogram import Dispatcher
 
 from config import Config
 from models.database import db
+from models.fsm_storage import create_fsm_storage
 from handlers import register_handlers
-from utils.logging_utils import set_main_bot, setup_logging_bridge
+from middlewares import register_middlewares
+from utils.logging_utils import log_shipper, set_main_bot, setup_logging_bridge
 from handlers.stripe_webhook import start_webhook_server
+from utils.telegram_webhook import serve_webhook
+from utils.gemini_utils import run_prompt_cache_refresher
+from utils.card_readings import run_card_readings_job
+from utils.maintenance import run_maintenance
+from utils.active_messages import active_messages
+from utils.tracing import exporter as trace_exporter
+from utils.telegram_sender import close_shared_session, get_bot
 
 logging.basicConfig(level=logging.INFO)
 
 async def main():
     logging.info(f"DATABASE_URL: {Config.DATABASE_URL}")
-    bot = Bot(token=Config.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher()
+    bot = get_bot(Config.BOT_TOKEN)
+    dp = Dispatcher(storage=create_fsm_storage())
 
     set_main_bot(bot)
     setup_logging_bridge(level=logging.WARNING)
 
     await db.connect()
     await db.create_tables()
+    asyncio.create_task(run_prompt_cache_refresher())
+    asyncio.create_task(run_card_readings_job())
+    asyncio.create_task(run_maintenance())
 
-    asyncio.create_task(start_webhook_server())
-
+    register_middlewares(dp)
     register_handlers(dp)
-    
-    await dp.start_polling(bot)
+    dp.shutdown.register(active_messages.close)
+    dp.shutdown.register(db.stats.close)
+    dp.shutdown.register(trace_exporter.close)
+
+    runner = await start_webhook_server(dp=dp, bot=bot)
+
+    try:
+        if Config.TELEGRAM_MODE == "webhook":
+            await serve_webhook(dp, bot)
+        else:
+            await bot.delete_webhook(drop_pending_updates=False)
+            # The shared session is closed once, by close_shared_session() below
+            await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        # Drains queued webhook updates before the session goes away
+        await runner.cleanup()
+        # Last batch of admin logs goes out while the session is still open
+        await log_shipper.close()
+        await close_shared_session()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,17 @@
+from aiogram import Dispatcher
+
+from .handler_metrics import HandlerMetricsMiddleware
+from .state_buffer import StateBufferMiddleware
+from .tracing import TracingMiddleware
+from .user_serial import user_serial
+
+def register_middlewares(dp: Dispatcher):
+    # Per-user ordering has to wrap aiogram's FSM middleware: otherwise the next update
+    # reads the FSM state before the previous update of the same user has written it.
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(TracingMiddleware())
+    dp.update.outer_middleware(user_serial)
+    dp.update.outer_middleware(dp.fsm)
+    dp.update.outer_middleware(StateBufferMiddleware())
+    dp.message.middleware(HandlerMetricsMiddleware("message"))
+    dp.callback_query.middleware(HandlerMetricsMiddleware("callback_query"))
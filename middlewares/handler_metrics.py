@@ -0,0 +1,30 @@
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from utils.metrics import handler_duration
+from utils.tracing import span
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Times each handler call into `bot_handler_duration_seconds`, labelled by handler function,
+    and wraps it in a `handler.<name>` trace span.
+
+    Registered as an inner middleware, so it only sees updates that matched a
+    handler and does not include time spent queued in the outer middlewares.
+    """
+
+    def __init__(self, event: str):
+        self.event = event
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        with span(f"handler.{name}"), handler_duration.time(event=self.event, handler=name):
+            return await handler(event, data)
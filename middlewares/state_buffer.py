@@ -0,0 +1,94 @@
+import copy
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.types import TelegramObject
+
+_MISSING = object()
+
+
+class BufferedFSMContext(FSMContext):
+    """FSMContext that keeps state and data in memory for one update.
+
+    The first read loads from storage, every later read/update works on the local
+    copy, and flush() writes the final state and data at most once each. Handlers
+    keep using the normal FSMContext API.
+    """
+
+    def __init__(self, context: FSMContext, raw_state: Any = _MISSING):
+        super().__init__(storage=context.storage, key=context.key)
+        self._state = raw_state
+        self._data: dict[str, Any] | None = None
+        self._state_dirty = False
+        self._data_dirty = False
+
+    async def _load_data(self) -> dict[str, Any]:
+        if self._data is None:
+            self._data = await self.storage.get_data(key=self.key)
+        return self._data
+
+    async def set_state(self, state=None) -> None:
+        self._state = state.state if isinstance(state, State) else state
+        self._state_dirty = True
+
+    async def get_state(self) -> str | None:
+        if self._state is _MISSING:
+            self._state = await self.storage.get_state(key=self.key)
+        return self._state
+
+    async def set_data(self, data: dict[str, Any]) -> None:
+        self._data = copy.deepcopy(dict(data))
+        self._data_dirty = True
+
+    async def get_data(self) -> dict[str, Any]:
+        return copy.deepcopy(await self._load_data())
+
+    async def get_value(self, key: str, default: Any | None = None) -> Any | None:
+        return copy.deepcopy((await self._load_data()).get(key, default))
+
+    async def update_data(self, data: dict[str, Any] | None = None, **kwargs: Any) -> dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        current = await self._load_data()
+        if kwargs:
+            current.update(copy.deepcopy(kwargs))
+            self._data_dirty = True
+        return copy.deepcopy(current)
+
+    async def clear(self) -> None:
+        await self.set_state(None)
+        await self.set_data({})
+
+    async def flush(self) -> None:
+        if self._state_dirty:
+            await self.storage.set_state(key=self.key, state=self._state)
+            self._state_dirty = False
+        if self._data_dirty:
+            await self.storage.set_data(key=self.key, data=self._data)
+            self._data_dirty = False
+
+
+class StateBufferMiddleware(BaseMiddleware):
+    """Replaces `state` with a BufferedFSMContext and flushes it once the update is handled.
+
+    Must run after aiogram's FSMContextMiddleware, i.e. be registered as an update
+    outer middleware after the Dispatcher is created.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        context = data.get("state")
+        if context is None:
+            return await handler(event, data)
+        buffered = BufferedFSMContext(context, data.get("raw_state", _MISSING))
+        data["state"] = buffered
+        try:
+            return await handler(event, data)
+        finally:
+            await buffered.flush()
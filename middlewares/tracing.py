@@ -0,0 +1,31 @@
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from utils.tracing import root_span
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Opens the root span of every update; DB, Gemini, Stripe and Bot API calls made
+    while handling it become its children (see utils/tracing.py).
+
+    Registered as the first update outer middleware so the trace includes time
+    spent waiting behind the same user's earlier updates.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        attributes = {}
+        if isinstance(event, Update):
+            attributes["update_id"] = event.update_id
+            attributes["type"] = event.event_type
+        user = data.get("event_from_user")
+        if user is not None:
+            attributes["user_id"] = user.id
+        with root_span("update", **attributes):
+            return await handler(event, data)
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from config import Config
+from utils.metrics import CounterFunc, Gauge
+
+
+class _UserSlot:
+    __slots__ = ("lock", "depth")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # updates of this user that are queued or running
+        self.depth = 0
+
+
+class UserSerialMiddleware(BaseMiddleware):
+    """Handles the updates of one user strictly one after another.
+
+    Different users run in parallel, bounded by `max_concurrency` handlers overall.
+    A user may have at most `max_queue_per_user` updates waiting; extra ones are
+    dropped. A callback press identical to one that is still queued or running
+    (same data on the same message) is answered and skipped, so a double tap on
+    "Продолжить" no longer starts two Gemini calls.
+
+    Must wrap aiogram's FSMContextMiddleware so the state is read only after the
+    previous update of the same user has been handled (see register_middlewares).
+    """
+
+    def __init__(self, max_concurrency: int, max_queue_per_user: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue_per_user = max_queue_per_user
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._users: dict[int, _UserSlot] = {}
+        self._callbacks: set[tuple] = set()
+        self.queued = 0
+        self.running = 0
+        self.dropped = 0
+        self.merged = 0
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._users),
+            "queued": self.queued,
+            "running": self.running,
+            "max_concurrency": self.max_concurrency,
+            "dropped": self.dropped,
+            "merged_callbacks": self.merged,
+        }
+
+    async def _run(self, handler, event, data):
+        # per-user order is already guaranteed here; this only caps total parallelism
+        async with self._slots:
+            self.running += 1
+            try:
+                return await handler(event, data)
+            finally:
+                self.running -= 1
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await self._run(handler, event, data)
+
+        callback = event.callback_query if isinstance(event, Update) else None
+        callback_key = None
+        if callback is not None:
+            message_id = callback.message.message_id if callback.message else callback.inline_message_id
+            callback_key = (user.id, callback.data, message_id)
+            if callback_key in self._callbacks:
+                self.merged += 1
+                await _answer_quietly(callback)
+                return None
+
+        slot = self._users.get(user.id)
+        if slot is None:
+            slot = self._users[user.id] = _UserSlot()
+        if slot.depth >= self.max_queue_per_user:
+            self.dropped += 1
+            logging.info(f"UserSerialMiddleware: dropping update for user {user.id}, {slot.depth} already queued")
+            if callback is not None:
+                await _answer_quietly(callback)
+            return None
+
+        if callback_key is not None:
+            self._callbacks.add(callback_key)
+        slot.depth += 1
+        self.queued += 1
+        started = False
+        try:
+            async with slot.lock:
+                self.queued -= 1
+                started = True
+                return await self._run(handler, event, data)
+        finally:
+            if not started:
+                self.queued -= 1
+            slot.depth -= 1
+            if slot.depth == 0:
+                self._users.pop(user.id, None)
+            if callback_key is not None:
+                self._callbacks.discard(callback_key)
+
+
+async def _answer_quietly(callback):
+    try:
+        await callback.answer()
+    except Exception as e:
+        logging.debug(f"Failed to answer skipped callback {callback.id}: {e}")
+
+
+user_serial = UserSerialMiddleware(
+    max_concurrency=Config.UPDATE_MAX_CONCURRENCY,
+    max_queue_per_user=Config.UPDATE_MAX_QUEUE_PER_USER,
+)
+Gauge("updates_in_flight", "Updates being handled or queued behind the same user",
+      lambda: {("running",): user_serial.running, ("queued",): user_serial.queued}, ("state",))
+CounterFunc("updates_dropped_total", "Updates dropped because a user's queue was full", lambda: user_serial.dropped)
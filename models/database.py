@@ -1,9 +1,154 @@
+import asyncio
 import asyncpg
+import logging
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from datetime import date, timedelta
+
 from config import Config
+from models.migrations import migrate
+from utils.metrics import CounterFunc, Gauge, db_pool_wait, db_query_duration
+from utils.tracing import detached_task, span
+
+# Rejection reasons returned by Database.try_spend
+SPEND_USER_NOT_FOUND = "user_not_found"
+SPEND_INSUFFICIENT_BALANCE = "insufficient_balance"
+SPEND_FREE_CARD_COOLDOWN = "free_card_cooldown"
+
+
+def _stats_ctes(source: str, deltas: str) -> str:
+    """CTEs that add `deltas` (a VALUES list of (name, delta)) to the running totals
+    and today's bucket once per row produced by the `source` CTE.
+
+    Appended to the statement that does the underlying write, so the counters
+    commit (or not) together with it.
+    """
+    return f"""
+        stat_delta AS (
+            SELECT v.name, v.delta::numeric AS delta FROM {source} CROSS JOIN (VALUES {deltas}) AS v(name, delta)
+        ),
+        stat_total AS (
+            INSERT INTO stats_counters AS c (name, value) SELECT name, delta FROM stat_delta
+            ON CONFLICT (name) DO UPDATE SET value = c.value + EXCLUDED.value
+        ),
+        stat_day AS (
+            INSERT INTO stats_daily AS d (day, name, value) SELECT CURRENT_DATE, name, delta FROM stat_delta
+            ON CONFLICT (day, name) DO UPDATE SET value = d.value + EXCLUDED.value
+        )
+    """
+
+
+class UserCache:
+    """In-process TTL/LRU cache of `users` rows keyed by user_id.
+
+    Only rows that exist are cached. Every write path in Database refreshes or
+    drops the entry, so the TTL only bounds staleness for writes made by other
+    processes (e.g. the standalone admin bot granting crystals).
+    """
+
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.ttl = ttl_seconds
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._rows: OrderedDict[int, tuple[float, asyncpg.Record]] = OrderedDict()
+
+    def get(self, user_id: int):
+        entry = self._rows.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._rows[user_id]
+            self.misses += 1
+            return None
+        self._rows.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, row):
+        if row is None or self.max_size <= 0:
+            return
+        self._rows[row['user_id']] = (time.monotonic() + self.ttl, row)
+        self._rows.move_to_end(row['user_id'])
+        while len(self._rows) > self.max_size:
+            self._rows.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._rows.pop(user_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._rows),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits / total) if total else 0.0,
+        }
+
+
+class StatsBuffer:
+    """Write-behind deltas for the high-rate counters (spreads, crystals spent).
+
+    Spreads are the hottest write path; bumping the same few stats rows in every
+    try_spend would serialize all users on their row locks. Deltas are summed in
+    memory instead and added with one upsert every `flush_interval` seconds.
+    """
+
+    def __init__(self, db: "Database", flush_interval: float):
+        self.db = db
+        self.flush_interval = flush_interval
+        self._pending: defaultdict[tuple[date, str], int] = defaultdict(int)
+        self._flush_task: asyncio.Task | None = None
+
+    def add(self, name: str, delta: int):
+        if not delta:
+            return
+        self._pending[(date.today(), name)] += delta
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = detached_task(self._flush_loop())
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, defaultdict(int)
+        try:
+            async with self.db.acquire("stats_flush") as conn:
+                await conn.execute(
+                    """
+                    WITH d AS (
+                        SELECT * FROM unnest($1::date[], $2::varchar[], $3::bigint[]) AS t(day, name, delta)
+                    ),
+                    stat_total AS (
+                        INSERT INTO stats_counters AS c (name, value) SELECT name, SUM(delta) FROM d GROUP BY name
+                        ON CONFLICT (name) DO UPDATE SET value = c.value + EXCLUDED.value
+                    )
+                    INSERT INTO stats_daily AS s (day, name, value) SELECT day, name, delta FROM d
+                    ON CONFLICT (day, name) DO UPDATE SET value = s.value + EXCLUDED.value
+                    """,
+                    [day for day, _ in batch], [name for _, name in batch], list(batch.values()),
+                )
+        except Exception as e:
+            logging.warning(f"Failed to flush {len(batch)} stats deltas, will retry: {e}")
+            for key, delta in batch.items():
+                self._pending[key] += delta
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
 
 class Database:
     def __init__(self):
         self.pool = None
+        self.user_cache = UserCache(Config.USER_CACHE_TTL_SECONDS, Config.USER_CACHE_MAX_SIZE)
+        self.stats = StatsBuffer(self, Config.STATS_FLUSH_SECONDS)
 
     async def connect(self):
         # Limit pool size to avoid hitting managed Postgres connection caps (e.g., on Render)
@@ -18,78 +163,147 @@ class Database:
         if self.pool:
             await self.pool.close()
 
+    @asynccontextmanager
+    async def acquire(self, name: str):
+        """Pool connection labelled `name` for the pool-wait and query-duration metrics and trace spans."""
+        with span(f"db.{name}") as current:
+            started = time.perf_counter()
+            async with self.pool.acquire() as conn:
+                waited = time.perf_counter() - started
+                db_pool_wait.observe(waited)
+                if current is not None:
+                    current.set(pool_wait_ms=round(waited * 1000, 1))
+                with db_query_duration.time(method=name):
+                    yield conn
+
     async def create_tables(self):
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    username VARCHAR(255),
-                    balance_crystals INTEGER DEFAULT 0,
-                    last_free_card_ts TIMESTAMP,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            """)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT REFERENCES users(user_id),
-                    payment_provider VARCHAR(50) DEFAULT 'stripe',
-                    payment_id VARCHAR(255) UNIQUE,
-                    amount_usd DECIMAL(10, 2),
-                    amount_crystals INTEGER,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            """)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS checkout_sessions (
-                    token VARCHAR(64) PRIMARY KEY,
-                    user_id BIGINT REFERENCES users(user_id),
-                    session_id VARCHAR(255) NOT NULL,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            """)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS active_messages (
-                    user_id BIGINT PRIMARY KEY REFERENCES users(user_id),
-                    message_id BIGINT,
-                    updated_at TIMESTAMP DEFAULT NOW()
-                )
-            """)
+        """Bring the schema up to date; two small reads when it already is (see models/migrations.py)."""
+        await migrate(self.pool)
 
     async def get_user(self, user_id):
-        async with self.pool.acquire() as conn:
-            return await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
+        user = self.user_cache.get(user_id)
+        if user is not None:
+            return user
+        async with self.acquire("get_user") as conn:
+            user = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
+        self.user_cache.put(user)
+        return user
 
     async def create_user(self, user_id, username):
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                "INSERT INTO users (user_id, username) VALUES ($1, $2) ON CONFLICT (user_id) DO NOTHING",
+        """Insert the user if missing. Returns the new row, or None if it already existed."""
+        async with self.acquire("create_user") as conn:
+            user = await conn.fetchrow(
+                f"""
+                WITH ins AS (
+                    INSERT INTO users (user_id, username) VALUES ($1, $2)
+                    ON CONFLICT (user_id) DO NOTHING
+                    RETURNING *
+                ),
+                {_stats_ctes("ins", "('users', 1)")}
+                SELECT * FROM ins
+                """,
                 user_id, username
             )
+        if user is not None:
+            self.user_cache.put(user)
+        else:
+            self.user_cache.invalidate(user_id)
+        return user
 
     async def update_balance(self, user_id, amount):
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE users SET balance_crystals = balance_crystals + $1 WHERE user_id = $2",
+        async with self.acquire("update_balance") as conn:
+            user = await conn.fetchrow(
+                "UPDATE users SET balance_crystals = balance_crystals + $1 WHERE user_id = $2 RETURNING *",
                 amount, user_id
             )
+        self.user_cache.put(user)
+        return user
 
     async def set_last_free_card(self, user_id):
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE users SET last_free_card_ts = NOW() WHERE user_id = $1",
+        async with self.acquire("set_last_free_card") as conn:
+            user = await conn.fetchrow(
+                "UPDATE users SET last_free_card_ts = NOW() WHERE user_id = $1 RETURNING *",
                 user_id
             )
+        self.user_cache.put(user)
+        return user
+
+    async def try_spend(self, user_id: int, cost: int, free_card_cooldown: timedelta | None = None):
+        """Atomically charge `cost` crystals and, for the free card, stamp last_free_card_ts.
+
+        The balance and cooldown guards live in the UPDATE's WHERE clause, so concurrent
+        taps cannot overspend. Returns (new_balance, None) on success or (None, reason)
+        with one of the SPEND_* reasons. Only on the rejection path the user row is
+        re-read from Postgres (the cached one may be what made the guard fail) to
+        tell the reasons apart.
+        """
+        async with self.acquire("try_spend") as conn:
+            user = await conn.fetchrow(
+                """
+                UPDATE users
+                SET balance_crystals = balance_crystals - $2,
+                    last_free_card_ts = CASE WHEN $3::interval IS NULL THEN last_free_card_ts ELSE NOW() END
+                WHERE user_id = $1
+                  AND ($2 = 0 OR balance_crystals >= $2)
+                  AND ($3::interval IS NULL OR last_free_card_ts IS NULL OR last_free_card_ts <= NOW() - $3::interval)
+                RETURNING *
+                """,
+                user_id, cost, free_card_cooldown
+            )
+        if user is not None:
+            self.user_cache.put(user)
+            self.stats.add("spreads", 1)
+            self.stats.add("crystals_spent", cost)
+            return user['balance_crystals'], None
+
+        self.user_cache.invalidate(user_id)
+        user = await self.get_user(user_id)
+        if user is None:
+            return None, SPEND_USER_NOT_FOUND
+        if cost > 0 and user['balance_crystals'] < cost:
+            return None, SPEND_INSUFFICIENT_BALANCE
+        return None, SPEND_FREE_CARD_COOLDOWN
+
+    async def credit_payment(self, user_id: int, payment_id: str, amount_usd, amount_crystals: int) -> int | None:
+        """Record a payment and credit its crystals exactly once.
+
+        The transaction insert and the balance update run as one statement, so they
+        commit together and a concurrent webhook and /success cannot both credit the
+        same payment_id. Returns the new balance, or None if the payment was already
+        recorded.
+        """
+        async with self.acquire("credit_payment") as conn:
+            user = await conn.fetchrow(
+                f"""
+                WITH tx AS (
+                    INSERT INTO transactions (user_id, payment_id, amount_usd, amount_crystals)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (payment_id) DO NOTHING
+                    RETURNING user_id, amount_crystals
+                ),
+                {_stats_ctes("tx", "('revenue_usd', $3), ('crystals_sold', $4), ('payments', 1)")}
+                UPDATE users u
+                SET balance_crystals = u.balance_crystals + tx.amount_crystals
+                FROM tx
+                WHERE u.user_id = tx.user_id
+                RETURNING u.*
+                """,
+                user_id, payment_id, amount_usd, amount_crystals
+            )
+        if user is None:
+            return None
+        self.user_cache.put(user)
+        return user['balance_crystals']
 
     async def record_transaction(self, user_id, payment_id, amount_usd, amount_crystals):
-        async with self.pool.acquire() as conn:
+        async with self.acquire("record_transaction") as conn:
             await conn.execute(
                 "INSERT INTO transactions (user_id, payment_id, amount_usd, amount_crystals) VALUES ($1, $2, $3, $4)",
                 user_id, payment_id, amount_usd, amount_crystals
             )
 
     async def transaction_exists(self, payment_id: str) -> bool:
-        async with self.pool.acquire() as conn:
+        async with self.acquire("transaction_exists") as conn:
             row = await conn.fetchrow(
                 "SELECT 1 FROM transactions WHERE payment_id = $1",
                 payment_id,
@@ -97,14 +311,14 @@ class Database:
             return row is not None
 
     async def save_checkout_session(self, user_id: int, token: str, session_id: str):
-        async with self.pool.acquire() as conn:
+        async with self.acquire("save_checkout_session") as conn:
             await conn.execute(
                 "INSERT INTO checkout_sessions (token, user_id, session_id) VALUES ($1, $2, $3) ON CONFLICT (token) DO UPDATE SET session_id = EXCLUDED.session_id, user_id = EXCLUDED.user_id",
                 token, user_id, session_id
             )
 
     async def get_session_id_by_token(self, token: str):
-        async with self.pool.acquire() as conn:
+        async with self.acquire("get_session_id_by_token") as conn:
             row = await conn.fetchrow(
                 "SELECT session_id FROM checkout_sessions WHERE token = $1",
                 token
@@ -112,14 +326,14 @@ class Database:
             return row['session_id'] if row else None
 
     async def delete_checkout_session(self, token: str):
-        async with self.pool.acquire() as conn:
+        async with self.acquire("delete_checkout_session") as conn:
             await conn.execute(
                 "DELETE FROM checkout_sessions WHERE token = $1",
                 token
             )
 
     async def get_active_message_id(self, user_id: int) -> int | None:
-        async with self.pool.acquire() as conn:
+        async with self.acquire("get_active_message_id") as conn:
             row = await conn.fetchrow(
                 "SELECT message_id FROM active_messages WHERE user_id = $1",
                 user_id,
@@ -127,10 +341,117 @@ class Database:
             return row['message_id'] if row else None
 
     async def set_active_message_id(self, user_id: int, message_id: int):
-        async with self.pool.acquire() as conn:
-            await conn.execute(
+        await self.set_active_message_ids([(user_id, message_id)])
+
+    async def set_active_message_ids(self, rows):
+        """Upsert (user_id, message_id) pairs in one round trip."""
+        async with self.acquire("set_active_message_ids") as conn:
+            await conn.executemany(
                 "INSERT INTO active_messages (user_id, message_id, updated_at) VALUES ($1, $2, NOW()) ON CONFLICT (user_id) DO UPDATE SET message_id = EXCLUDED.message_id, updated_at = NOW()",
-                user_id, message_id,
+                rows,
+            )
+
+    async def get_cached_response(self, cache_key: str, ttl: timedelta):
+        async with self.acquire("get_cached_response") as conn:
+            return await conn.fetchrow(
+                "SELECT response, EXTRACT(EPOCH FROM NOW() - created_at)::float8 AS age_seconds FROM ai_response_cache WHERE cache_key = $1 AND created_at > NOW() - $2::interval",
+                cache_key, ttl,
+            )
+
+    async def put_cached_response(self, cache_key: str, response: str):
+        async with self.acquire("put_cached_response") as conn:
+            await conn.execute(
+                "INSERT INTO ai_response_cache (cache_key, response, created_at) VALUES ($1, $2, NOW()) ON CONFLICT (cache_key) DO UPDATE SET response = EXCLUDED.response, created_at = NOW()",
+                cache_key, response,
+            )
+
+    async def get_card_readings(self):
+        async with self.acquire("get_card_readings") as conn:
+            return await conn.fetch("SELECT card, category, reading, generated_at FROM card_readings")
+
+    async def put_card_readings(self, rows):
+        """Upsert (card, category, reading) tuples in one round trip."""
+        async with self.acquire("put_card_readings") as conn:
+            await conn.executemany(
+                "INSERT INTO card_readings (card, category, reading, generated_at) VALUES ($1, $2, $3, NOW()) "
+                "ON CONFLICT (card, category) DO UPDATE SET reading = EXCLUDED.reading, generated_at = NOW()",
+                rows,
             )
 
+    async def acquire_job_lease(self, name: str, owner: str, ttl: timedelta) -> bool:
+        """Take or renew the named lease for `ttl`; False while another owner holds an unexpired one."""
+        async with self.acquire("acquire_job_lease") as conn:
+            return await conn.fetchval(
+                "INSERT INTO job_leases (name, owner, locked_until) VALUES ($1, $2, NOW() + $3::interval) "
+                "ON CONFLICT (name) DO UPDATE SET owner = EXCLUDED.owner, locked_until = EXCLUDED.locked_until "
+                "WHERE job_leases.owner = EXCLUDED.owner OR job_leases.locked_until < NOW() "
+                "RETURNING TRUE",
+                name, owner, ttl,
+            ) is not None
+
+    async def release_job_lease(self, name: str, owner: str):
+        async with self.acquire("release_job_lease") as conn:
+            await conn.execute("DELETE FROM job_leases WHERE name = $1 AND owner = $2", name, owner)
+
+    async def create_broadcast(self, text: str, admin_chat_id: int | None, progress_message_id: int | None, owner: str):
+        """Insert a running broadcast already claimed by `owner` (fresh heartbeat)."""
+        async with self.acquire("create_broadcast") as conn:
+            return await conn.fetchrow(
+                "INSERT INTO broadcasts (text, admin_chat_id, progress_message_id, owner, heartbeat_at) VALUES ($1, $2, $3, $4, NOW()) RETURNING *",
+                text, admin_chat_id, progress_message_id, owner,
+            )
+
+    async def claim_stale_broadcasts(self, stale_after: timedelta, owner: str):
+        """Hand running broadcasts whose worker stopped heartbeating (crash/restart) to `owner`."""
+        async with self.acquire("claim_stale_broadcasts") as conn:
+            return await conn.fetch(
+                "UPDATE broadcasts SET heartbeat_at = NOW(), owner = $2 "
+                "WHERE status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < NOW() - $1::interval) "
+                "RETURNING *",
+                stale_after, owner,
+            )
+
+    # The writes below return False once another worker has claimed the broadcast
+
+    async def heartbeat_broadcast(self, broadcast_id: int, owner: str) -> bool:
+        async with self.acquire("heartbeat_broadcast") as conn:
+            status = await conn.execute(
+                "UPDATE broadcasts SET heartbeat_at = NOW() WHERE id = $1 AND owner = $2 AND status = 'running'",
+                broadcast_id, owner,
+            )
+        return status != "UPDATE 0"
+
+    async def checkpoint_broadcast(self, broadcast_id: int, owner: str, last_user_id: int, sent: int, failed: int) -> bool:
+        async with self.acquire("checkpoint_broadcast") as conn:
+            status = await conn.execute(
+                "UPDATE broadcasts SET last_user_id = $3, sent = $4, failed = $5, heartbeat_at = NOW() WHERE id = $1 AND owner = $2",
+                broadcast_id, owner, last_user_id, sent, failed,
+            )
+        return status != "UPDATE 0"
+
+    async def finish_broadcast(self, broadcast_id: int, owner: str, status: str = "done") -> bool:
+        async with self.acquire("finish_broadcast") as conn:
+            result = await conn.execute(
+                "UPDATE broadcasts SET status = $3, finished_at = NOW() WHERE id = $1 AND owner = $2",
+                broadcast_id, owner, status,
+            )
+        return result != "UPDATE 0"
+
+    async def get_stats(self, days: int = 7):
+        """Running totals plus the last `days` daily buckets, both keyed by counter name."""
+        await self.stats.flush()
+        async with self.acquire("get_stats") as conn:
+            totals = await conn.fetch("SELECT name, value FROM stats_counters")
+            daily = await conn.fetch(
+                "SELECT day, name, value FROM stats_daily WHERE day > CURRENT_DATE - $1::int ORDER BY day",
+                days,
+            )
+        return {r['name']: r['value'] for r in totals}, daily
+
 db = Database()
+
+Gauge("db_pool_connections", "asyncpg pool connections by state",
+      lambda: {("open",): db.pool.get_size(), ("idle",): db.pool.get_idle_size()} if db.pool else {}, ("state",))
+Gauge("user_cache_size", "Rows in the in-process user cache", lambda: db.user_cache.stats()["size"])
+CounterFunc("user_cache_lookups_total", "User cache lookups",
+             lambda: {("hit",): db.user_cache.hits, ("miss",): db.user_cache.misses}, ("result",))
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+from datetime import timedelta
+from typing import Any
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import Config
+from models.database import db
+from utils.tracing import detached_task
+
+_MISSING = object()
+_EMPTY_DATA = "{}"
+
+_UPSERT_SQL = """
+    INSERT INTO fsm_storage AS s (key, state, data, updated_at)
+    VALUES ($1, $2, COALESCE($3::jsonb, '{}'::jsonb), NOW())
+    ON CONFLICT (key) DO UPDATE SET
+        state = CASE WHEN $4 THEN EXCLUDED.state
+                     WHEN s.updated_at <= NOW() - $6::interval THEN NULL
+                     ELSE s.state END,
+        data = CASE WHEN $5 THEN EXCLUDED.data
+                    WHEN s.updated_at <= NOW() - $6::interval THEN '{}'::jsonb
+                    ELSE s.data END,
+        updated_at = NOW()
+"""
+
+
+def _storage_key(key: StorageKey) -> str:
+    parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+    thread_id = getattr(key, "thread_id", None)
+    business_connection_id = getattr(key, "business_connection_id", None)
+    if thread_id:
+        parts.append(f"t{thread_id}")
+    if business_connection_id:
+        parts.append(f"b{business_connection_id}")
+    if key.destiny != "default":
+        parts.append(key.destiny)
+    return ":".join(parts)
+
+
+class PostgresStorage(BaseStorage):
+    """aiogram FSM storage in the `fsm_storage` table on the shared asyncpg pool.
+
+    One row per key holds the state name and the data as compact JSONB, so sessions
+    survive restarts and can be shared by several bot replicas.
+
+    Writes are coalesced: set_state/set_data only buffer the change and a flush runs
+    `flush_delay` seconds later, so the back-to-back update_data calls of one handler
+    become a single upsert. Reads see buffered writes of this process first.
+
+    Rows untouched for longer than `ttl` (SESSION_TIMEOUT_MINUTES by default) are
+    treated as empty, matching the dialog session timeout.
+    """
+
+    def __init__(self, database=db, ttl: timedelta | None = None, flush_delay: float = 0.05):
+        self.db = database
+        self.ttl = ttl or timedelta(minutes=Config.SESSION_TIMEOUT_MINUTES)
+        self.flush_delay = flush_delay
+        # key -> {"state": str | None, "data": json str}; only the fields that changed
+        self._pending: dict[str, dict[str, Any]] = {}
+        # batch currently being written, still visible to readers until committed
+        self._inflight: dict[str, dict[str, Any]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+
+    def _buffered(self, key: str, field: str):
+        for layer in (self._pending, self._inflight):
+            entry = layer.get(key)
+            if entry is not None and field in entry:
+                return entry[field]
+        return _MISSING
+
+    def _buffer(self, key: str, field: str, value):
+        self._pending.setdefault(key, {})[field] = value
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = detached_task(self._flush_later(self.flush_delay))
+
+    async def _load(self, key: str):
+        async with self.db.acquire("fsm_load") as conn:
+            return await conn.fetchrow(
+                "SELECT state, data FROM fsm_storage WHERE key = $1 AND updated_at > NOW() - $2::interval",
+                key, self.ttl,
+            )
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        self._buffer(_storage_key(key), "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        k = _storage_key(key)
+        state = self._buffered(k, "state")
+        if state is not _MISSING:
+            return state
+        row = await self._load(k)
+        return row['state'] if row else None
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        self._buffer(_storage_key(key), "data", json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        k = _storage_key(key)
+        data = self._buffered(k, "data")
+        if data is _MISSING:
+            row = await self._load(k)
+            data = row['data'] if row else None
+        return json.loads(data) if data else {}
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        await self.flush()
+
+    async def flush(self):
+        """Write all buffered changes: one executemany upsert plus one delete for cleared keys."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            self._inflight = batch
+            cleared = [k for k, e in batch.items() if e.get("state", _MISSING) is None and e.get("data") == _EMPTY_DATA]
+            upserts = [
+                (k, e.get("state"), e.get("data"), "state" in e, "data" in e, self.ttl)
+                for k, e in batch.items() if k not in cleared
+            ]
+            try:
+                async with self.db.acquire("fsm_flush") as conn:
+                    if upserts:
+                        await conn.executemany(_UPSERT_SQL, upserts)
+                    if cleared:
+                        await conn.execute("DELETE FROM fsm_storage WHERE key = ANY($1::varchar[])", cleared)
+            except Exception as e:
+                logging.error(f"PostgresStorage: failed to flush {len(batch)} FSM keys, will retry: {e}")
+                for k, entry in batch.items():
+                    self._pending[k] = {**entry, **self._pending.get(k, {})}
+                if self._flush_task is None or self._flush_task.done() or self._flush_task is asyncio.current_task():
+                    self._flush_task = detached_task(self._flush_later(1.0))
+            finally:
+                self._inflight = {}
+
+    async def close(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done() and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+        await self.flush()
+
+
+def create_fsm_storage() -> BaseStorage:
+    """Storage for the user-facing dispatcher, selected by FSM_STORAGE (postgres|memory)."""
+    if Config.FSM_STORAGE == "postgres":
+        return PostgresStorage(db)
+    return MemoryStorage()
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import re
+from dataclasses import dataclass
+
+# Only one process applies migrations at a time
+_LOCK_ID = 0x6D696772
+_CONCURRENT_INDEX_RE = re.compile(r"CREATE\s+INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    statements: tuple[str, ...]
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    transactional: bool = True
+
+
+# One-off backfill of the stats tables from existing rows, only while they are empty
+_STATS_BACKFILL_SQL = """
+    WITH fresh AS (SELECT NOT EXISTS (SELECT 1 FROM stats_counters) AS yes),
+    totals AS (
+        INSERT INTO stats_counters (name, value)
+        SELECT 'users', COUNT(*) FROM users WHERE (SELECT yes FROM fresh)
+        UNION ALL
+        SELECT 'revenue_usd', COALESCE(SUM(amount_usd), 0) FROM transactions WHERE (SELECT yes FROM fresh)
+        UNION ALL
+        SELECT 'crystals_sold', COALESCE(SUM(amount_crystals), 0) FROM transactions WHERE (SELECT yes FROM fresh)
+        UNION ALL
+        SELECT 'payments', COUNT(*) FROM transactions WHERE (SELECT yes FROM fresh)
+        ON CONFLICT (name) DO NOTHING
+    )
+    INSERT INTO stats_daily (day, name, value)
+    SELECT created_at::date, 'users', COUNT(*) FROM users
+    WHERE (SELECT yes FROM fresh) AND created_at IS NOT NULL GROUP BY 1
+    UNION ALL
+    SELECT created_at::date, 'revenue_usd', SUM(amount_usd) FROM transactions
+    WHERE (SELECT yes FROM fresh) AND created_at IS NOT NULL GROUP BY 1
+    UNION ALL
+    SELECT created_at::date, 'crystals_sold', SUM(amount_crystals) FROM transactions
+    WHERE (SELECT yes FROM fresh) AND created_at IS NOT NULL GROUP BY 1
+    UNION ALL
+    SELECT created_at::date, 'payments', COUNT(*) FROM transactions
+    WHERE (SELECT yes FROM fresh) AND created_at IS NOT NULL GROUP BY 1
+    ON CONFLICT (day, name) DO NOTHING
+"""
+
+MIGRATIONS = [
+    Migration(1, "baseline tables", (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username VARCHAR(255),
+            balance_crystals INTEGER DEFAULT 0,
+            last_free_card_ts TIMESTAMP,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transactions (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users(user_id),
+            payment_provider VARCHAR(50) DEFAULT 'stripe',
+            payment_id VARCHAR(255) UNIQUE,
+            amount_usd DECIMAL(10, 2),
+            amount_crystals INTEGER,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS checkout_sessions (
+            token VARCHAR(64) PRIMARY KEY,
+            user_id BIGINT REFERENCES users(user_id),
+            session_id VARCHAR(255) NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS active_messages (
+            user_id BIGINT PRIMARY KEY REFERENCES users(user_id),
+            message_id BIGINT,
+            updated_at TIMESTAMP DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key VARCHAR(255) PRIMARY KEY,
+            state VARCHAR(255),
+            data JSONB NOT NULL DEFAULT '{}'::jsonb,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ai_response_cache (
+            cache_key VARCHAR(64) PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS card_readings (
+            card VARCHAR(64) NOT NULL,
+            category VARCHAR(32) NOT NULL,
+            reading TEXT NOT NULL,
+            generated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (card, category)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            status VARCHAR(16) NOT NULL DEFAULT 'running',
+            admin_chat_id BIGINT,
+            progress_message_id BIGINT,
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            heartbeat_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name VARCHAR(32) PRIMARY KEY,
+            value NUMERIC(16, 2) NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day DATE NOT NULL,
+            name VARCHAR(32) NOT NULL,
+            value NUMERIC(16, 2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, name)
+        )
+        """,
+        _STATS_BACKFILL_SQL,
+    )),
+    Migration(2, "indexes for admin lookups and checkout cleanup", (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_username_idx ON users (username)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS transactions_user_created_idx ON transactions (user_id, created_at DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS checkout_sessions_created_idx ON checkout_sessions (created_at)",
+    ), transactional=False),
+    Migration(3, "indexes for the expired-row reaper", (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS active_messages_updated_idx ON active_messages (updated_at)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS fsm_storage_updated_idx ON fsm_storage (updated_at)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ai_response_cache_created_idx ON ai_response_cache (created_at)",
+    ), transactional=False),
+    Migration(4, "leases for background jobs", (
+        """
+        CREATE TABLE IF NOT EXISTS job_leases (
+            name VARCHAR(64) PRIMARY KEY,
+            owner VARCHAR(64) NOT NULL,
+            locked_until TIMESTAMP NOT NULL
+        )
+        """,
+    )),
+    Migration(5, "broadcast owner", (
+        # Rows without an owner are claimed (and get one) like any stale broadcast
+        "ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS owner VARCHAR(64)",
+    )),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+async def _current_version(conn) -> int:
+    if await conn.fetchval("SELECT to_regclass('schema_migrations')") is None:
+        return 0
+    return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+
+
+async def _drop_invalid_index(conn, statement: str):
+    """A CREATE INDEX CONCURRENTLY that was interrupted leaves an INVALID index behind,
+    which IF NOT EXISTS would then silently keep. Drop it so the statement rebuilds it."""
+    match = _CONCURRENT_INDEX_RE.search(statement)
+    if match is None:
+        return
+    name = match.group(1)
+    if await conn.fetchval("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", name):
+        logging.warning(f"Dropping invalid index {name} left by an interrupted migration")
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+async def _apply(conn, migration: Migration):
+    if migration.transactional:
+        async with conn.transaction():
+            for statement in migration.statements:
+                await conn.execute(statement)
+            await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", migration.version, migration.name)
+        return
+    for statement in migration.statements:
+        await _drop_invalid_index(conn, statement)
+        await conn.execute(statement)
+    await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", migration.version, migration.name)
+
+
+async def migrate(pool):
+    """Apply pending migrations in version order.
+
+    When the schema is already at LATEST_VERSION this costs two small reads
+    (does schema_migrations exist, its MAX(version)) and no DDL runs. Otherwise an
+    advisory lock serializes concurrent starts (main bot, admin bot, several
+    replicas) and each migration is recorded in schema_migrations once applied.
+    Waiters poll the lock instead of blocking on it, and stop as soon as the
+    holder has brought the schema up to date.
+    """
+    async with pool.acquire() as conn:
+        while True:
+            if await _current_version(conn) >= LATEST_VERSION:
+                return
+            if await conn.fetchval("SELECT pg_try_advisory_lock($1)", _LOCK_ID):
+                break
+            await asyncio.sleep(1)
+        try:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+                )
+            """)
+            current = await _current_version(conn)
+            for migration in MIGRATIONS:
+                if migration.version <= current:
+                    continue
+                logging.info(f"Applying schema migration {migration.version}: {migration.name}")
+                await _apply(conn, migration)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", _LOCK_ID)
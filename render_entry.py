@@ -1,51 +1,81 @@
 import asyncio
 import logging
 import os
-from aiogram import Bot, Dispatcher
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
+from aiogram import Dispatcher
 
 from config import Config
 from models.database import db
+from models.fsm_storage import create_fsm_storage
 from handlers import register_handlers
-from utils.logging_utils import set_main_bot, setup_logging_bridge
+from middlewares import register_middlewares
+from utils.logging_utils import log_shipper, set_main_bot, setup_logging_bridge
 from handlers.stripe_webhook import start_webhook_server
+from utils.telegram_webhook import serve_webhook
+from utils.gemini_utils import run_prompt_cache_refresher
+from utils.card_readings import run_card_readings_job
+from utils.maintenance import run_maintenance
+from utils.active_messages import active_messages
+from utils.tracing import exporter as trace_exporter
+from utils.telegram_sender import close_shared_session, get_bot
 from admin_bot import get_admin_router
+from utils.broadcast import close_broadcasts, resume_broadcasts
 
 logging.basicConfig(level=logging.INFO)
 
 async def run():
     logging.info(f"DATABASE_URL: {Config.DATABASE_URL}")
-    bot = Bot(token=Config.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher()
+    bot = get_bot(Config.BOT_TOKEN)
+    dp = Dispatcher(storage=create_fsm_storage())
     set_main_bot(bot)
     setup_logging_bridge(level=logging.WARNING)
 
     await db.connect()
     await db.create_tables()
-
-    asyncio.create_task(start_webhook_server())
+    asyncio.create_task(run_prompt_cache_refresher())
+    asyncio.create_task(run_card_readings_job())
+    asyncio.create_task(run_maintenance())
 
     # Register all bot handlers so updates are processed
+    register_middlewares(dp)
     register_handlers(dp)
+    dp.shutdown.register(active_messages.close)
+    dp.shutdown.register(db.stats.close)
+    dp.shutdown.register(trace_exporter.close)
+
+    runner = await start_webhook_server(dp=dp, bot=bot)
 
     # Optionally start admin bot in the same process if token provided
     admin_task = None
     if Config.ADMIN_BOT_TOKEN:
-        admin_bot = Bot(token=Config.ADMIN_BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+        admin_bot = get_bot(Config.ADMIN_BOT_TOKEN)
         admin_dp = Dispatcher()
         admin_dp.include_router(get_admin_router())
-        admin_task = asyncio.create_task(admin_dp.start_polling(admin_bot))
+        await resume_broadcasts(reporter=admin_bot)
+        admin_task = asyncio.create_task(admin_dp.start_polling(admin_bot, close_bot_session=False))
+
+    if Config.TELEGRAM_MODE == "webhook":
+        main_task = serve_webhook(dp, bot)
+    else:
+        # getUpdates is rejected while a webhook is registered (e.g. after switching modes)
+        await bot.delete_webhook(drop_pending_updates=False)
+        # The shared session is closed once, by close_shared_session() below
+        main_task = dp.start_polling(bot, close_bot_session=False)
 
     try:
         if admin_task:
             await asyncio.gather(
-                dp.start_polling(bot),
+                main_task,
                 admin_task,
             )
         else:
-            await dp.start_polling(bot)
+            await main_task
     finally:
+        await close_broadcasts()
+        # Drains queued webhook updates before the session and the pool go away
+        await runner.cleanup()
+        # Last batch of admin logs goes out while the session is still open
+        await log_shipper.close()
+        await close_shared_session()
         # Graceful shutdown: close DB pool to free connections
         try:
             await db.disconnect()
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+import asyncpg
+from aiogram import Bot
+
+from config import Config
+from models.database import db
+from utils.telegram_sender import PRIORITY_BACKGROUND, send_priority
+from utils.tracing import detached_task
+
+_UNKNOWN = object()
+# Worth retrying on the next flush: the database was unreachable, not the rows wrong
+_TRANSIENT_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    # Closed connection or pool
+    asyncpg.InterfaceError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.TooManyConnectionsError,
+)
+# Consecutive failed flushes after which the batch is dropped; the in-memory map stays authoritative
+_MAX_FLUSH_ATTEMPTS = 5
+
+
+class ActiveMessageTracker:
+    """Which message in each chat currently carries the live inline keyboard.
+
+    The in-memory map is authoritative: `activate` swaps the entry synchronously
+    and the old keyboard is cleared by a background task. Changes are written
+    behind to `active_messages` in batches every `flush_interval` seconds, so the
+    table only matters after a restart (or for chats evicted from the LRU).
+    """
+
+    def __init__(self, max_size: int, flush_interval: float):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._current: OrderedDict[int, int] = OrderedDict()
+        self._dirty: dict[int, int] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._flush_task: asyncio.Task | None = None
+        self._failed_flushes = 0
+
+    def _remember(self, chat_id: int, message_id: int):
+        self._current[chat_id] = message_id
+        self._current.move_to_end(chat_id)
+        while len(self._current) > self.max_size:
+            self._current.popitem(last=False)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def activate(self, bot: Bot, chat_id: int, message_id: int):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = detached_task(self._flush_loop())
+        prev = self._current.get(chat_id, _UNKNOWN)
+        self._remember(chat_id, message_id)
+        if prev is _UNKNOWN:
+            # Not seen since start: the previous id is in the table, which must be
+            # read before this change is flushed over it
+            self._spawn(self._resolve(bot, chat_id, message_id))
+            return
+        self._dirty[chat_id] = message_id
+        if prev != message_id:
+            self._spawn(self._clear_keyboard(bot, chat_id, prev))
+
+    async def _resolve(self, bot: Bot, chat_id: int, message_id: int):
+        try:
+            prev = await db.get_active_message_id(chat_id)
+        except Exception as e:
+            logging.debug(f"Failed to load active message for {chat_id}: {e}")
+            prev = None
+        current = self._current.get(chat_id, message_id)
+        self._dirty.setdefault(chat_id, current)
+        if prev and prev != message_id and prev != current:
+            await self._clear_keyboard(bot, chat_id, prev)
+
+    async def _clear_keyboard(self, bot: Bot, chat_id: int, message_id: int):
+        try:
+            with send_priority(PRIORITY_BACKGROUND):
+                await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=None)
+        except Exception as e:
+            logging.debug(f"Failed to clear previous inline keyboard for user {chat_id}: {e}")
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            await db.set_active_message_ids(list(batch.items()))
+        except asyncpg.IntegrityConstraintViolationError as e:
+            # e.g. a chat without a users row: one bad row must not block the rest forever
+            logging.warning(f"Active messages batch of {len(batch)} rejected ({e}), writing rows one by one")
+            await self._flush_rows(batch)
+        except _TRANSIENT_ERRORS as e:
+            self._requeue(batch, e)
+        except Exception as e:
+            logging.error(f"Failed to flush {len(batch)} active messages, dropping them: {e}")
+        else:
+            self._failed_flushes = 0
+
+    async def _flush_rows(self, batch: dict[int, int]):
+        failed = {}
+        for chat_id, message_id in batch.items():
+            try:
+                await db.set_active_message_id(chat_id, message_id)
+            except _TRANSIENT_ERRORS:
+                failed[chat_id] = message_id
+            except Exception as e:
+                logging.warning(f"Dropping active message {message_id} for chat {chat_id}: {e}")
+        if failed:
+            self._requeue(failed, "database unavailable")
+        else:
+            self._failed_flushes = 0
+
+    def _requeue(self, batch: dict[int, int], error):
+        self._failed_flushes += 1
+        if self._failed_flushes >= _MAX_FLUSH_ATTEMPTS:
+            logging.error(f"Dropping {len(batch)} active messages after {self._failed_flushes} failed flushes: {error}")
+            self._failed_flushes = 0
+            return
+        logging.warning(f"Failed to flush {len(batch)} active messages, will retry: {error}")
+        for chat_id, message_id in batch.items():
+            self._dirty.setdefault(chat_id, message_id)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
+
+
+active_messages = ActiveMessageTracker(
+    max_size=Config.ACTIVE_MESSAGES_MAX_SIZE,
+    flush_interval=Config.ACTIVE_MESSAGES_FLUSH_SECONDS,
+)
@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import time
+import uuid
+from contextlib import aclosing
+from datetime import timedelta
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from config import Config
+from models.database import db
+from utils import logging_utils
+from utils.rate_limit import TokenBucket
+from utils.telegram_sender import PRIORITY_BULK, get_bot, set_priority
+from utils.tracing import detached_task
+
+# A running broadcast whose heartbeat is older than this is considered orphaned
+_STALE_AFTER = timedelta(minutes=2)
+# Written by a timer while a broadcast runs, so long RetryAfter pauses do not look like a crash
+_HEARTBEAT_SECONDS = 30
+# Broadcasts this process runs; checkpoints are only written while the row still names it
+_OWNER = uuid.uuid4().hex
+_MAX_SEND_ATTEMPTS = 3
+
+# Shared by every broadcast in this process so parallel broadcasts cannot exceed it together
+_bucket = TokenBucket(Config.BROADCAST_RATE_PER_SECOND)
+_tasks: dict[int, asyncio.Task] = {}
+_watchdog: asyncio.Task | None = None
+
+
+def _sender_bot() -> Bot:
+    """The main bot when it runs in this process, otherwise its client on the shared session."""
+    return logging_utils.main_bot or get_bot(Config.BOT_TOKEN)
+
+
+def _parts(text: str, n: int = 4000) -> list[str]:
+    # Telegram text limit is ~4096
+    return [text[i:i + n] for i in range(0, len(text), n)]
+
+
+async def _iter_recipients(after_user_id: int):
+    """Yield user ids above `after_user_id` in id order, BROADCAST_WINDOW rows per query.
+
+    Each window is one keyset query whose connection goes back to the pool before
+    any message is sent, so a broadcast holds neither a connection nor a snapshot
+    while it waits on Telegram.
+    """
+    while True:
+        async with db.acquire("broadcast_recipients") as conn:
+            rows = await conn.fetch(
+                "SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2",
+                after_user_id, Config.BROADCAST_WINDOW,
+            )
+        for row in rows:
+            yield row['user_id']
+        if len(rows) < Config.BROADCAST_WINDOW:
+            return
+        after_user_id = rows[-1]['user_id']
+
+
+class _ClaimLost(Exception):
+    """Another worker took the broadcast over; this one must stop sending."""
+
+
+class Broadcast:
+    def __init__(self, row, reporter: Bot | None):
+        self.id = row['id']
+        self.text = row['text']
+        self.admin_chat_id = row['admin_chat_id']
+        self.progress_message_id = row['progress_message_id']
+        self.last_user_id = row['last_user_id']
+        self.sent = row['sent']
+        self.failed = row['failed']
+        self.reporter = reporter
+        self._started = time.monotonic()
+        self._started_count = self.sent + self.failed
+        self._reported_at = 0.0
+        self.status = "running"
+
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self._started
+        return (self.sent + self.failed - self._started_count) / elapsed if elapsed > 0 else 0.0
+
+    def progress_text(self) -> str:
+        head = f"Рассылка #{self.id} " + {"running": "идёт", "done": "завершена"}.get(self.status, "остановлена из-за ошибки")
+        return f"{head}\nОтправлено: {self.sent}\nОшибок: {self.failed}\nСкорость: {self.rate():.1f} сообщ./с"
+
+    async def report(self, final: bool = False):
+        if self.reporter is None or self.admin_chat_id is None:
+            return
+        now = time.monotonic()
+        if not final and now - self._reported_at < Config.BROADCAST_PROGRESS_SECONDS:
+            return
+        self._reported_at = now
+        text = self.progress_text()
+        try:
+            if self.progress_message_id:
+                await self.reporter.edit_message_text(text, chat_id=self.admin_chat_id, message_id=self.progress_message_id)
+            else:
+                msg = await self.reporter.send_message(self.admin_chat_id, text)
+                self.progress_message_id = msg.message_id
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e).lower():
+                logging.warning(f"Broadcast #{self.id}: failed to update progress: {e}")
+        except Exception as e:
+            logging.warning(f"Broadcast #{self.id}: failed to update progress: {e}")
+
+    async def _send_one(self, bot: Bot, user_id: int) -> bool:
+        for part in _parts(self.text):
+            for attempt in range(1, _MAX_SEND_ATTEMPTS + 1):
+                await _bucket.acquire()
+                try:
+                    await bot.send_message(user_id, part)
+                    break
+                except TelegramRetryAfter as e:
+                    _bucket.pause(e.retry_after)
+                    if attempt == _MAX_SEND_ATTEMPTS:
+                        logging.warning(f"Broadcast #{self.id}: giving up on {user_id} after RetryAfter x{attempt}")
+                        return False
+                except TelegramForbiddenError:
+                    # Blocked the bot or deactivated: expected for part of the audience
+                    return False
+                except Exception as e:
+                    logging.debug(f"Broadcast #{self.id}: failed to send to {user_id}: {e}")
+                    return False
+        return True
+
+    async def _send_chunk(self, bot: Bot, user_ids: list[int]):
+        results = await asyncio.gather(*(self._send_one(bot, uid) for uid in user_ids))
+        ok = sum(results)
+        self.sent += ok
+        self.failed += len(results) - ok
+        self.last_user_id = user_ids[-1]
+        if not await db.checkpoint_broadcast(self.id, _OWNER, self.last_user_id, self.sent, self.failed):
+            raise _ClaimLost()
+        await self.report()
+
+    async def _heartbeat(self, runner: asyncio.Task):
+        while True:
+            await asyncio.sleep(_HEARTBEAT_SECONDS)
+            try:
+                alive = await db.heartbeat_broadcast(self.id, _OWNER)
+            except Exception as e:
+                logging.warning(f"Broadcast #{self.id}: heartbeat failed: {e}")
+                continue
+            if not alive:
+                logging.warning(f"Broadcast #{self.id}: claimed by another worker, stopping")
+                runner.cancel()
+                return
+
+    async def run(self):
+        """Send to every user after the last checkpoint, one chunk at a time.
+
+        A checkpoint (last user id + counters) is written after each chunk, so a
+        restart resends at most one chunk. A timer keeps the heartbeat fresh in
+        between; if another worker has claimed the broadcast meanwhile (heartbeat
+        or checkpoint finds a different owner), this run stops.
+        """
+        # User-facing replies go first when the bot's global rate limit is saturated
+        set_priority(PRIORITY_BULK)
+        bot = _sender_bot()
+        chunk: list[int] = []
+        heartbeat = asyncio.create_task(self._heartbeat(asyncio.current_task()))
+        try:
+            async with aclosing(_iter_recipients(self.last_user_id)) as recipients:
+                async for user_id in recipients:
+                    chunk.append(user_id)
+                    if len(chunk) >= Config.BROADCAST_CHUNK_SIZE:
+                        await self._send_chunk(bot, chunk)
+                        chunk = []
+            if chunk:
+                await self._send_chunk(bot, chunk)
+        except asyncio.CancelledError:
+            # Left as 'running': the next start resumes from the checkpoint
+            raise
+        except _ClaimLost:
+            logging.warning(f"Broadcast #{self.id}: claimed by another worker, stopping at user {self.last_user_id}")
+            return
+        except Exception as e:
+            logging.error(f"Broadcast #{self.id} stopped at user {self.last_user_id}: {e}")
+            self.status = "failed"
+            if await db.finish_broadcast(self.id, _OWNER, self.status):
+                await self.report(final=True)
+            return
+        finally:
+            heartbeat.cancel()
+        self.status = "done"
+        if not await db.finish_broadcast(self.id, _OWNER, self.status):
+            logging.warning(f"Broadcast #{self.id}: claimed by another worker before it finished")
+            return
+        logging.info(f"Broadcast #{self.id} done: sent={self.sent} failed={self.failed}")
+        await self.report(final=True)
+
+
+def _spawn(row, reporter: Bot | None) -> Broadcast:
+    broadcast = Broadcast(row, reporter)
+    task = detached_task(broadcast.run())
+    _tasks[broadcast.id] = task
+    task.add_done_callback(lambda _: _tasks.pop(broadcast.id, None))
+    return broadcast
+
+
+async def start_broadcast(text: str, reporter: Bot | None = None, admin_chat_id: int | None = None, progress_message_id: int | None = None) -> Broadcast:
+    """Persist a new broadcast and send it in the background; progress is edited into `progress_message_id`."""
+    row = await db.create_broadcast(text, admin_chat_id, progress_message_id, _OWNER)
+    return _spawn(row, reporter)
+
+
+async def _claim_orphans(reporter: Bot | None):
+    for row in await db.claim_stale_broadcasts(_STALE_AFTER, _OWNER):
+        if row['id'] in _tasks:
+            continue
+        logging.warning(f"Resuming broadcast #{row['id']} after user {row['last_user_id']}")
+        _spawn(row, reporter)
+
+
+async def _watch_orphans(reporter: Bot | None):
+    # A quick restart finds its own broadcasts not yet stale; they are claimed once they are
+    while True:
+        await asyncio.sleep(_STALE_AFTER.total_seconds() / 2)
+        try:
+            await _claim_orphans(reporter)
+        except Exception as e:
+            logging.warning(f"Broadcast: orphan check failed: {e}")
+
+
+async def resume_broadcasts(reporter: Bot | None = None):
+    """Pick up broadcasts left running by a crashed or restarted process.
+
+    Claims the stale ones now and keeps checking in the background until
+    close_broadcasts().
+    """
+    global _watchdog
+    await _claim_orphans(reporter)
+    if _watchdog is None or _watchdog.done():
+        _watchdog = detached_task(_watch_orphans(reporter))
+
+
+async def close_broadcasts():
+    """Stop running broadcasts; they resume from the checkpoint on the next start."""
+    global _watchdog
+    if _watchdog is not None:
+        _watchdog.cancel()
+        _watchdog = None
+    for task in list(_tasks.values()):
+        task.cancel()
+    await asyncio.gather(*_tasks.values(), return_exceptions=True)
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import re
+import uuid
+from datetime import datetime, timedelta
+
+from config import Config
+from models.database import db
+from utils.gemini_utils import generate_card_reading
+from utils.tarot_utils import TAROT_CARDS
+
+# category -> (topic for the generation prompt, question word stems)
+CATEGORIES = {
+    "love": ("отношения и близость", (
+        "любов", "люби", "любл", "отношен", "партн", "парн", "девушк", "муж", "жен", "брак", "свидан",
+        "расстав", "бывш", "чувств", "нрав", "ревн", "семь",
+    )),
+    "work": ("работа, карьера и дела", (
+        "работ", "карьер", "должност", "начальник", "коллег", "проект", "бизнес", "учеб",
+        "экзамен", "собеседован", "професс", "ваканс", "уволь", "увольн",
+    )),
+    "money": ("деньги и ресурсы", (
+        "деньг", "денег", "финанс", "зарплат", "долг", "кредит", "доход", "расход", "покупк",
+        "инвест", "накоплен", "ипотек",
+    )),
+    "self": ("внутреннее состояние и самоощущение", (
+        "себя", "себе", "тревог", "страх", "устал", "выгоран", "смысл", "настроен",
+        "эмоци", "уверенн", "самооцен", "здоров", "энерги",
+    )),
+    "general": ("общая ситуация человека сейчас", ()),
+}
+
+_WORD_RE = re.compile(r"\w+")
+# Lease row in job_leases so only one replica runs the batch at a time. It is
+# renewed after every batch and simply expires if the holder dies.
+_JOB_NAME = "card_readings"
+_JOB_OWNER = uuid.uuid4().hex
+_LEASE = timedelta(minutes=10)
+# The job's own cap on in-flight generations, so it never takes more than a few
+# of the GEMINI_MAX_CONCURRENCY slots that user requests wait on
+_job_semaphore = asyncio.Semaphore(max(1, Config.CARD_READINGS_CONCURRENCY))
+
+
+def classify_question(question: str) -> str:
+    """Map a free-form question to a reading category by keyword stems; the category with most hits wins."""
+    words = _WORD_RE.findall((question or "").lower().replace("ё", "е"))
+    best, best_hits = "general", 0
+    for category, (_, stems) in CATEGORIES.items():
+        hits = sum(1 for w in words if w.startswith(stems)) if stems else 0
+        if hits > best_hits:
+            best, best_hits = category, hits
+    return best
+
+
+class CardReadingStore:
+    """In-memory copy of the `card_readings` table (78 cards × categories, a few hundred rows)."""
+
+    def __init__(self):
+        self._readings: dict[tuple[str, str], tuple[str, datetime]] = {}
+
+    def __len__(self):
+        return len(self._readings)
+
+    def get(self, card: str, category: str) -> str | None:
+        entry = self._readings.get((card, category)) or self._readings.get((card, "general"))
+        return entry[0] if entry else None
+
+    async def load(self):
+        rows = await db.get_card_readings()
+        self._readings = {(r['card'], r['category']): (r['reading'], r['generated_at']) for r in rows}
+
+    def stale(self, max_age: timedelta) -> list[tuple[str, str]]:
+        """(card, category) pairs that are missing or older than max_age."""
+        cutoff = datetime.now() - max_age
+        return [
+            (card, category)
+            for card in TAROT_CARDS
+            for category in CATEGORIES
+            if (entry := self._readings.get((card, category))) is None or entry[1] < cutoff
+        ]
+
+
+card_readings = CardReadingStore()
+
+
+async def _generate_one(card: str, category: str) -> str | None:
+    async with _job_semaphore:
+        return await generate_card_reading(card, CATEGORIES[category][0])
+
+
+async def _generate_batch(pairs: list[tuple[str, str]]) -> int:
+    readings = await asyncio.gather(*(_generate_one(card, category) for card, category in pairs))
+    rows = [(card, category, text) for (card, category), text in zip(pairs, readings) if text]
+    if rows:
+        await db.put_card_readings(rows)
+    return len(rows)
+
+
+async def refresh_card_readings():
+    """Generate missing/outdated readings, CARD_READINGS_BATCH_SIZE requests at a time.
+
+    Runs under a lease row so several replicas do not pay for the same
+    generations; the loser just reloads what the winner wrote. No connection is
+    held while Gemini works.
+    """
+    if not await db.acquire_job_lease(_JOB_NAME, _JOB_OWNER, _LEASE):
+        await card_readings.load()
+        return
+    try:
+        await card_readings.load()
+        pairs = card_readings.stale(timedelta(days=Config.CARD_READINGS_MAX_AGE_DAYS))
+        if not pairs:
+            return
+        logging.info(f"Card readings: generating {len(pairs)} readings")
+        size = max(1, Config.CARD_READINGS_BATCH_SIZE)
+        stored = 0
+        for i in range(0, len(pairs), size):
+            stored += await _generate_batch(pairs[i:i + size])
+            if not await db.acquire_job_lease(_JOB_NAME, _JOB_OWNER, _LEASE):
+                logging.warning("Card readings: lease lost to another replica, stopping")
+                break
+        logging.info(f"Card readings: stored {stored}/{len(pairs)} readings")
+        await card_readings.load()
+    finally:
+        await db.release_job_lease(_JOB_NAME, _JOB_OWNER)
+
+
+async def run_card_readings_job():
+    """Background loop: refresh at startup, then every CARD_READINGS_REFRESH_HOURS."""
+    if not Config.CARD_READINGS:
+        return
+    while True:
+        try:
+            await refresh_card_readings()
+        except Exception as e:
+            logging.warning(f"Card readings: refresh failed: {e}")
+        await asyncio.sleep(Config.CARD_READINGS_REFRESH_HOURS * 3600)
@@ -1,10 +1,33 @@
 from google import genai
+from google.genai import errors as genai_errors
 from google.genai import types
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
 import logging
+import random
+import time
+from collections import defaultdict
 
 from config import Config
+from utils.response_cache import response_cache, response_cache_key
+from utils.history import select_history
+from utils.llm_resilience import CircuitBreaker, CircuitOpenError, LatencyTracker, backoff_delay
+from utils.tracing import span
+from utils.metrics import CounterFunc, Gauge, ai_reading_duration, ai_reading_tokens, gemini_duration, gemini_tokens
 client = genai.Client(api_key=Config.GEMINI_API_KEY)
 
+# Caps in-flight Gemini requests so a burst of readings cannot exhaust the API quota
+# or pile up unbounded coroutines; extra callers simply wait for a free slot.
+_gemini_semaphore = asyncio.Semaphore(Config.GEMINI_MAX_CONCURRENCY)
+# Only used when the installed SDK has no async client (client.aio).
+_executor = ThreadPoolExecutor(max_workers=Config.GEMINI_MAX_CONCURRENCY, thread_name_prefix="gemini")
+# Per-model health, shared by all calls in this process
+_latency: defaultdict[str, LatencyTracker] = defaultdict(LatencyTracker)
+_breakers: defaultdict[str, CircuitBreaker] = defaultdict(
+    lambda: CircuitBreaker(Config.GEMINI_BREAKER_FAILURES, Config.GEMINI_BREAKER_RESET_SECONDS)
+)
+
 SYSTEM_PROMPT = (
     """
     Ты — Нить. Твоя роль — помочь разобраться в ситуации через карты Таро как инструмент для размышлений. Ты не гадалка, а собеседник.
@@ -31,18 +54,150 @@ SYSTEM_PROMPT = (
     """
 )
 
-def generate_ai_response(user_display_name, card_names, user_question, message_history=None):
+_EMPTY_FALLBACK = (
+    "Хм… у меня не получилось сформулировать ответ. Попробуй уточнить вопрос или задать контекст иначе: "
+    "что важно понять, какой выбор перед тобой, какие чувства/факты задействованы."
+)
+_ERROR_FALLBACK = (
+    "Похоже, возникла пауза на моей стороне. Давай попробуем ещё раз: "
+    "переформулируй вопрос одним-двумя предложениями."
+)
+
+
+class _PromptCache:
+    """Explicit Gemini context cache holding SYSTEM_PROMPT for one model.
+
+    Requests reference the cache by name instead of resending the instructions, so
+    the static prefix is billed at the cached-token rate. If the cache cannot be
+    created (caching disabled, API error) requests fall back to a plain
+    system_instruction. A prompt below the model's minimum cacheable size disables
+    the cache for good: Gemini would reject every attempt.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.name: str | None = None
+        self.expires_at = 0.0
+        self.retry_at = 0.0
+        self.disabled = False
+        self.failures = 0
+        self._size_checked = False
+        self._lock = asyncio.Lock()
+
+    def current(self) -> str | None:
+        if self.name and time.monotonic() < self.expires_at:
+            return self.name
+        return None
+
+    def invalidate(self):
+        """Forget a cache Gemini no longer accepts; the refresher recreates it."""
+        self.name = None
+        self.expires_at = 0.0
+
+    def needs_refresh(self) -> bool:
+        if self.disabled:
+            return False
+        ttl = Config.GEMINI_PROMPT_CACHE_TTL_MINUTES * 60
+        return time.monotonic() >= max(self.expires_at - ttl * 0.2, self.retry_at)
+
+    async def refresh(self):
+        async with self._lock:
+            if not self.needs_refresh():
+                return
+            if not self._size_checked and not await self._check_size():
+                return
+            ttl = int(Config.GEMINI_PROMPT_CACHE_TTL_MINUTES * 60)
+            old_name = self.name
+            try:
+                cache = await client.aio.caches.create(
+                    model=self.model,
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=SYSTEM_PROMPT,
+                        display_name="thread-system-prompt",
+                        ttl=f"{ttl}s",
+                    ),
+                )
+            except Exception as e:
+                self.retry_at = time.monotonic() + 600
+                self.failures += 1
+                log = logging.warning if self.failures == 1 else logging.debug
+                log(f"Gemini: failed to create prompt cache for {self.model} ({self.failures} in a row), using system_instruction: {e}")
+                return
+            self.failures = 0
+            self.name = cache.name
+            self.expires_at = time.monotonic() + ttl - 60
+            logging.info(f"Gemini: prompt cache {cache.name} ready for {self.model}")
+            if old_name:
+                try:
+                    await client.aio.caches.delete(name=old_name)
+                except Exception as e:
+                    logging.debug(f"Gemini: failed to delete old prompt cache {old_name}: {e}")
+
+    async def _check_size(self) -> bool:
+        """Disable the cache if SYSTEM_PROMPT is below the minimum Gemini will cache."""
+        try:
+            result = await client.aio.models.count_tokens(model=self.model, contents=SYSTEM_PROMPT)
+        except Exception as e:
+            # Not fatal: caches.create reports the same problem, just less cheaply
+            logging.debug(f"Gemini: failed to count prompt tokens for {self.model}: {e}")
+            return True
+        self._size_checked = True
+        tokens = result.total_tokens or 0
+        if tokens < Config.GEMINI_PROMPT_CACHE_MIN_TOKENS:
+            self.disabled = True
+            logging.info(
+                f"Gemini: system prompt is {tokens} tokens, below the {Config.GEMINI_PROMPT_CACHE_MIN_TOKENS} "
+                f"needed to cache it; prompt cache disabled for {self.model}"
+            )
+            return False
+        return True
+
+
+_prompt_caches: dict[str, _PromptCache] = {}
+
+
+def _prompt_cache(model: str) -> _PromptCache:
+    cache = _prompt_caches.get(model)
+    if cache is None:
+        cache = _prompt_caches[model] = _PromptCache(model)
+    return cache
+
+
+def _generation_config(model: str, temperature: float, top_p: float) -> types.GenerateContentConfig:
+    cached = _prompt_cache(model).current() if Config.GEMINI_PROMPT_CACHE else None
+    if cached:
+        return types.GenerateContentConfig(cached_content=cached, temperature=temperature, top_p=top_p)
+    return types.GenerateContentConfig(system_instruction=SYSTEM_PROMPT, temperature=temperature, top_p=top_p)
+
+
+async def run_prompt_cache_refresher():
+    """Create the SYSTEM_PROMPT cache at startup and recreate it before it expires."""
+    if not Config.GEMINI_PROMPT_CACHE or getattr(client, "aio", None) is None:
+        return
+    models = [Config.GEMINI_MODEL]
+    if Config.GEMINI_FALLBACK_MODEL and Config.GEMINI_FALLBACK_MODEL != Config.GEMINI_MODEL:
+        models.append(Config.GEMINI_FALLBACK_MODEL)
+    while True:
+        for model in models:
+            cache = _prompt_cache(model)
+            if cache.needs_refresh():
+                await cache.refresh()
+        await asyncio.sleep(60)
+
+
+def _build_prompt(user_display_name, card_names, user_question, message_history=None, history_summary=None) -> str:
     name_part = f"Имя пользователя: {user_display_name}." if user_display_name else "Имя пользователя: неизвестно."
     context = (
         f"{name_part} Его расклад: {', '.join(card_names)}. "
         f"Его вопрос: {user_question}."
     )
 
+    recent, summary = select_history(message_history or [], history_summary)
     history_text = ""
-    if message_history:
+    if recent:
         lines = []
 
-        for msg in message_history[-8:]:
+        for msg in recent:
             role = (msg.get("role") or "user").lower()
             role_name = "Пользователь" if role == "user" else "Модель"
             text = msg.get("content") or ""
@@ -50,19 +205,262 @@ def generate_ai_response(user_display_name, card_names, user_question, message_h
         if lines:
             history_text = "\n".join(lines)
 
-    base_prompt = f"{SYSTEM_PROMPT}\n\n{context}\n\nЦель: Дай разбор по вопросу пользователя, опираясь на метафоры карт."
+    base_prompt = f"{context}\n\nЦель: Дай разбор по вопросу пользователя, опираясь на метафоры карт."
+    if summary:
+        base_prompt += f"\n\nКратко о более раннем диалоге:\n{summary}"
     if history_text:
         base_prompt += f"\n\nПредыдущий диалог:\n{history_text}"
+    return base_prompt
+
+
+def _extract_text(response) -> str | None:
+    if getattr(response, "text", None):
+        return response.text
+    for cand in getattr(response, "candidates", None) or []:
+        content = getattr(cand, "content", None)
+        if not content:
+            continue
+        parts = getattr(content, "parts", None) or []
+        texts = [t for t in (getattr(part, "text", None) for part in parts) if t]
+        if texts:
+            return "\n".join(texts)
+    return None
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    """Timeouts, rate limits, 5xx and transport errors are worth retrying; other 4xx are not."""
+    code = getattr(exc, "code", None)
+    if isinstance(code, int) and 400 <= code < 500:
+        return code in (408, 429)
+    return True
+
+
+def _admit(model: str) -> tuple[bool, CircuitBreaker | None]:
+    """Ask the model's breaker for a call; also returns the breaker if that call is its half-open probe."""
+    breaker = _breakers[model]
+    probe = breaker.state == "half_open"
+    if not breaker.allow():
+        return False, None
+    return True, breaker if probe else None
+
+
+def _pick_model(exclude: str | None = None) -> tuple[str, CircuitBreaker | None]:
+    """Primary model unless it is overloaded (breaker open) or currently slow.
+
+    While the primary's p95 is above GEMINI_SLOW_P95_SECONDS most calls go to the
+    fallback model, with a small share still probing the primary so its latency
+    stats can recover. Only the returned model's breaker is asked; if the call holds
+    its half-open probe the breaker is returned too, and the caller must release()
+    it once the call is over, whatever the outcome. Raises CircuitOpenError when
+    every breaker refuses.
+    """
+    primary, fallback = Config.GEMINI_MODEL, Config.GEMINI_FALLBACK_MODEL
+    if not fallback or fallback == primary:
+        allowed, probe = _admit(primary)
+        if allowed:
+            return primary, probe
+        raise CircuitOpenError(f"circuit breaker for {primary} is open")
+    if exclude == primary:
+        allowed, probe = _admit(fallback)
+        if allowed:
+            return fallback, probe
+    p95 = _latency[primary].p95()
+    if p95 is not None and p95 > Config.GEMINI_SLOW_P95_SECONDS and random.random() > 0.1:
+        allowed, probe = _admit(fallback)
+        if allowed:
+            return fallback, probe
+    allowed, probe = _admit(primary)
+    if allowed:
+        return primary, probe
+    allowed, probe = _admit(fallback)
+    if allowed:
+        return fallback, probe
+    raise CircuitOpenError(f"circuit breakers for {primary} and {fallback} are open")
+
+
+def _is_stale_cache_error(exc: BaseException, config: types.GenerateContentConfig) -> bool:
+    """The request referenced the prompt cache and Gemini no longer has it (expired or deleted)."""
+    return bool(config.cached_content) and isinstance(exc, genai_errors.ClientError) and exc.code in (403, 404)
+
+
+async def _call_model(model: str, contents: str, temperature: float, top_p: float, timeout: float):
+    """One generate_content call: takes a concurrency slot, enforces `timeout`, feeds latency and breaker stats.
+
+    A request that hits an expired prompt cache is repeated once right away with
+    the plain system_instruction; the model is fine, so the breaker is not told.
+    """
+    config = _generation_config(model, temperature, top_p)
+    try:
+        return await _request(model, contents, config, timeout)
+    except genai_errors.ClientError as e:
+        if not _is_stale_cache_error(e, config):
+            raise
+        _prompt_cache(model).invalidate()
+        logging.info(f"Gemini: prompt cache for {model} is gone, repeating the request without it")
+        return await _request(model, contents, _generation_config(model, temperature, top_p), timeout)
+
+
+async def _request(model: str, contents: str, config: types.GenerateContentConfig, timeout: float):
+    kwargs = dict(model=model, contents=contents, config=config)
+    async with _gemini_semaphore:
+        started = time.monotonic()
+        aio = getattr(client, "aio", None)
+        if aio is not None:
+            call = aio.models.generate_content(**kwargs)
+        else:
+            loop = asyncio.get_running_loop()
+            call = loop.run_in_executor(_executor, functools.partial(client.models.generate_content, **kwargs))
+        try:
+            with span("gemini.generate", model=model) as current, gemini_duration.time(model=model):
+                response = await asyncio.wait_for(call, timeout=timeout)
+                usage = getattr(response, "usage_metadata", None)
+                if current is not None and usage is not None:
+                    current.set(tokens=usage.total_token_count or 0, cached_tokens=usage.cached_content_token_count or 0)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if _is_retryable(e):
+                _breakers[model].record_failure()
+            raise
+    _latency[model].observe(time.monotonic() - started)
+    _breakers[model].record_success()
+    _record_usage(model, getattr(response, "usage_metadata", None))
+    return response
+
+
+def _record_usage(model: str, usage):
+    if usage is None:
+        return
+    cached = usage.cached_content_token_count or 0
+    gemini_tokens.inc((usage.prompt_token_count or 0) - cached, model=model, kind="prompt")
+    gemini_tokens.inc(cached, model=model, kind="cached")
+    gemini_tokens.inc(usage.candidates_token_count or 0, model=model, kind="output")
+
+
+def _observe_reading(mode: str, started: float, text: str, responses):
+    outcome = "fallback" if text in (_EMPTY_FALLBACK, _ERROR_FALLBACK) else "ok"
+    ai_reading_duration.observe(time.monotonic() - started, mode=mode, outcome=outcome)
+    tokens = sum((getattr(r, "usage_metadata", None) and r.usage_metadata.total_token_count) or 0 for r in responses)
+    if tokens:
+        ai_reading_tokens.observe(tokens)
+
 
+async def _hedged_call(model: str, contents: str, temperature: float, top_p: float, timeout: float):
+    """Call the model; if no answer arrives within the model's p95, fire a second identical request.
+
+    Whichever succeeds first wins and the other is cancelled. Hedging is skipped
+    while every concurrency slot is busy, so it never adds load under pressure.
+    """
+    first = asyncio.create_task(_call_model(model, contents, temperature, top_p, timeout))
+    p95 = _latency[model].p95()
+    hedge_after = max(p95, Config.GEMINI_HEDGE_MIN_DELAY_SECONDS) if p95 is not None else None
+    tasks = {first}
     try:
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
+        if Config.GEMINI_HEDGE and hedge_after is not None and hedge_after < timeout:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done and not _gemini_semaphore.locked():
+                logging.info(f"Gemini: hedging {model} request after {hedge_after:.1f}s")
+                tasks.add(asyncio.create_task(_call_model(model, contents, temperature, top_p, timeout - hedge_after)))
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def _generate_content(contents: str, temperature: float, top_p: float):
+    """Run generate_content through the resilient call layer.
+
+    Picks the model (primary/fallback, circuit breakers), hedges slow calls and
+    retries retryable failures with jittered exponential backoff while the overall
+    GEMINI_DEADLINE_SECONDS allows. Each attempt is capped by GEMINI_TIMEOUT_SECONDS.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + Config.GEMINI_DEADLINE_SECONDS
+    model = None
+    attempt = 0
+    while True:
+        attempt += 1
+        probe = None
+        try:
+            # CircuitOpenError is retryable: a breaker may half-open before the deadline
+            model, probe = _pick_model(exclude=model if attempt > 1 else None)
+            remaining = deadline - loop.time()
+            return await _hedged_call(model, contents, temperature, top_p, timeout=min(remaining, Config.GEMINI_TIMEOUT_SECONDS))
+        except Exception as e:
+            if attempt >= Config.GEMINI_RETRY_ATTEMPTS or not _is_retryable(e):
+                raise
+            delay = backoff_delay(attempt, Config.GEMINI_RETRY_BASE_SECONDS, 5.0)
+            if loop.time() + delay + 1.0 >= deadline:
+                raise
+            logging.warning(f"Gemini: attempt {attempt} failed ({type(e).__name__}: {e}); retrying in {delay:.1f}s")
+        finally:
+            if probe is not None:
+                probe.release()
+        await asyncio.sleep(delay)
+
+
+def resilience_stats() -> dict:
+    return {
+        model: {
+            "breaker": _breakers[model].state,
+            "p95_seconds": _latency[model].p95(),
+        }
+        for model in {Config.GEMINI_MODEL, Config.GEMINI_FALLBACK_MODEL} if model
+    }
+
+
+def _cache_key_for(spread, card_names, user_question, message_history, history_summary=None):
+    """Only first readings of spreads listed in AI_CACHE_SPREADS are cacheable."""
+    if not spread or spread not in Config.AI_CACHE_SPREADS or message_history or history_summary:
+        return None
+    return response_cache_key(spread, card_names, user_question)
+
+
+async def generate_ai_response(user_display_name, card_names, user_question, message_history=None, spread=None, history_summary=None):
+    """Return the AI answer for a reading.
+
+    Pass `spread` (the selected_action) to allow serving the first reading from the
+    response cache; cacheable answers are generated without the user's name so they
+    can be shown to anyone.
+    """
+    cache_key = _cache_key_for(spread, card_names, user_question, message_history, history_summary)
+    if cache_key is None:
+        return await _generate_answer(user_display_name, card_names, user_question, message_history, history_summary)
+    cached = await response_cache.get(cache_key)
+    if cached:
+        return cached
+    text = await _generate_answer(None, card_names, user_question, message_history)
+    if text not in (_EMPTY_FALLBACK, _ERROR_FALLBACK):
+        response_cache.put(cache_key, text)
+    return text
+
+
+async def _generate_answer(user_display_name, card_names, user_question, message_history=None, history_summary=None):
+    started = time.monotonic()
+    responses = []
+    text = await _answer(user_display_name, card_names, user_question, message_history, history_summary, responses)
+    _observe_reading("generate", started, text, responses)
+    return text
+
+
+async def _answer(user_display_name, card_names, user_question, message_history, history_summary, responses: list):
+    """The non-streaming answer; every Gemini response used is appended to `responses`."""
+    base_prompt = _build_prompt(user_display_name, card_names, user_question, message_history, history_summary)
+
+    try:
+        response = await _generate_content(
             contents=base_prompt + "\n\nЗадание: Сформулируй ответ строго по структуре выше. Используй 2–4 ключевые карты из расклада и привяжи их к вопросу.",
-            config=types.GenerateContentConfig(
-                temperature=0.8,
-                top_p=0.9,
-            ),
+            temperature=0.8,
+            top_p=0.9,
         )
+        responses.append(response)
         if getattr(response, "text", None):
             return response.text
 
@@ -76,37 +474,135 @@ def generate_ai_response(user_display_name, card_names, user_question, message_h
         except Exception as e:
             logging.debug(f"Gemini(new): failed to extract finish reasons: {e}")
 
-        for cand in candidates:
-            content = getattr(cand, "content", None)
-            if not content:
-                continue
-            parts = getattr(content, "parts", None) or []
-            texts = []
-            for part in parts:
-                t = getattr(part, "text", None)
-                if t:
-                    texts.append(t)
-            if texts:
-                return "\n".join(texts)
+        text = _extract_text(response)
+        if text:
+            return text
 
         logging.info("Gemini(new): retrying with safer settings")
-        resp2 = client.models.generate_content(
-            model="gemini-2.5-flash",
+        resp2 = await _generate_content(
             contents=base_prompt + "\n\nЗадание: Дай краткий, нейтральный и безопасный ответ по структуре: 1) переформулируй вопрос, 2) 2 карты с осмыслением, 3) 1 наблюдение, 4) 1 вопрос к себе, 5) 1 шаг.",
-            config=types.GenerateContentConfig(
-                temperature=0.6,
-                top_p=0.8,
-                ),
+            temperature=0.6,
+            top_p=0.8,
         )
+        responses.append(resp2)
         if getattr(resp2, "text", None):
             return resp2.text
 
-        return (
-            "Хм… у меня не получилось сформулировать ответ. Попробуй уточнить вопрос или задать контекст иначе: "
-            "что важно понять, какой выбор перед тобой, какие чувства/факты задействованы."
-        )
-    except Exception:
-        return (
-            "Похоже, возникла пауза на моей стороне. Давай попробуем ещё раз: "
-            "переформулируй вопрос одним-двумя предложениями."
-        )
+        return _EMPTY_FALLBACK
+    except asyncio.TimeoutError:
+        logging.warning(f"Gemini(new): request timed out within {Config.GEMINI_DEADLINE_SECONDS}s deadline; user={user_display_name}")
+        return _ERROR_FALLBACK
+    except Exception as e:
+        logging.warning(f"Gemini(new): request failed after retries: {e}")
+        return _ERROR_FALLBACK
+
+
+async def generate_card_reading(card: str, topic: str) -> str | None:
+    """Question-agnostic reading of one card for a question topic (Карта Дня).
+
+    Used by the batch job in utils.card_readings. Returns None instead of a
+    fallback text so failures are simply retried on the next run.
+    """
+    prompt = (
+        f"Карта дня: {card}. Тема вопроса: {topic}. Конкретного вопроса и имени пользователя нет.\n\n"
+        "Задание: Дай толкование этой карты для темы по структуре: 1) смысл карты для этой темы в 1–2 предложениях, "
+        "2) 2 наблюдения или гипотезы, 3) 1–2 вопроса к себе, 4) 1 маленький шаг на сегодня. "
+        "Не пересказывай вопрос — его нет; обращайся на «ты»."
+    )
+    try:
+        response = await _generate_content(contents=prompt, temperature=0.7, top_p=0.9)
+    except Exception as e:
+        logging.warning(f"Gemini(card): failed to generate reading for {card} ({topic}): {e}")
+        return None
+    return getattr(response, "text", None) or _extract_text(response) or None
+
+
+async def stream_ai_response(user_display_name, card_names, user_question, message_history=None, on_text=None, spread=None, history_summary=None):
+    """Stream the answer and return the full text once generation is done.
+
+    ``on_text`` is called synchronously with the accumulated text after every chunk,
+    so it must not block (see utils.streaming.StreamingEditor.push). If the stream
+    fails or times out, any partial text is discarded and the non-streaming call
+    produces the answer instead. `spread` enables the response cache exactly as in
+    generate_ai_response.
+    """
+    aio = getattr(client, "aio", None)
+    if aio is None:
+        return await generate_ai_response(user_display_name, card_names, user_question, message_history, spread=spread, history_summary=history_summary)
+
+    cache_key = _cache_key_for(spread, card_names, user_question, message_history, history_summary)
+    if cache_key is not None:
+        cached = await response_cache.get(cache_key)
+        if cached:
+            return cached
+        user_display_name = None
+
+    base_prompt = _build_prompt(user_display_name, card_names, user_question, message_history, history_summary)
+    text = ""
+    try:
+        model, probe = _pick_model()
+    except CircuitOpenError as e:
+        # No model to stream from; the non-streaming path waits for one within its deadline
+        logging.warning(f"Gemini(stream): {e}")
+        text = await _generate_answer(user_display_name, card_names, user_question, message_history, history_summary)
+        if cache_key is not None and text not in (_EMPTY_FALLBACK, _ERROR_FALLBACK):
+            response_cache.put(cache_key, text)
+        return text
+    config = _generation_config(model, temperature=0.8, top_p=0.9)
+    started = time.monotonic()
+    usage_chunk = None
+    completed = False
+    try:
+        with span("gemini.stream", model=model):
+            async with _gemini_semaphore:
+                async with asyncio.timeout(Config.GEMINI_TIMEOUT_SECONDS):
+                    stream = await aio.models.generate_content_stream(
+                        model=model,
+                        contents=base_prompt + "\n\nЗадание: Сформулируй ответ строго по структуре выше. Используй 2–4 ключевые карты из расклада и привяжи их к вопросу.",
+                        config=config,
+                    )
+                    async for chunk in stream:
+                        if getattr(chunk, "usage_metadata", None) is not None:
+                            usage_chunk = chunk
+                        piece = _extract_text(chunk)
+                        if not piece:
+                            continue
+                        text += piece
+                        if on_text:
+                            on_text(text)
+        completed = True
+        _latency[model].observe(time.monotonic() - started)
+        _breakers[model].record_success()
+        gemini_duration.observe(time.monotonic() - started, model=model, outcome="ok")
+    except asyncio.TimeoutError:
+        gemini_duration.observe(time.monotonic() - started, model=model, outcome="error")
+        _breakers[model].record_failure()
+        logging.warning(f"Gemini(stream): {model} timed out after {Config.GEMINI_TIMEOUT_SECONDS}s; got {len(text)} chars; user={user_display_name}")
+    except Exception as e:
+        gemini_duration.observe(time.monotonic() - started, model=model, outcome="error")
+        if _is_retryable(e):
+            _breakers[model].record_failure()
+        if _is_stale_cache_error(e, config):
+            _prompt_cache(model).invalidate()
+        logging.warning(f"Gemini(stream): {model} failed after {len(text)} chars: {e}")
+    finally:
+        if probe is not None:
+            probe.release()
+
+    responses = []
+    if usage_chunk is not None:
+        _record_usage(model, usage_chunk.usage_metadata)
+        responses.append(usage_chunk)
+    if not completed or not text:
+        # A truncated stream is not an answer: never show it as final or cache it
+        text = await _answer(user_display_name, card_names, user_question, message_history, history_summary, responses)
+    _observe_reading("stream", started, text, responses)
+    if cache_key is not None and text not in (_EMPTY_FALLBACK, _ERROR_FALLBACK):
+        response_cache.put(cache_key, text)
+    return text
+
+
+Gauge("gemini_breaker_open", "1 while the model's circuit breaker is not closed",
+      lambda: {(m,): int(s["breaker"] != "closed") for m, s in resilience_stats().items()}, ("model",))
+CounterFunc("ai_response_cache_lookups_total", "AI response cache lookups",
+            lambda: {("hit",): response_cache.hits, ("miss",): response_cache.misses}, ("result",))
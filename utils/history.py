@@ -0,0 +1,81 @@
+import re
+
+from config import Config
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?…])\s")
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate, close enough to Gemini's count for budgeting.
+
+    Every punctuation mark is one token; words cost one token per ~4 Latin or
+    ~3 Cyrillic characters.
+    """
+    total = 0
+    for tok in _TOKEN_RE.findall(text or ""):
+        total += max(1, -(-len(tok) // (4 if tok.isascii() else 3)))
+    return total
+
+
+def _role_name(msg: dict) -> str:
+    return "Пользователь" if (msg.get("role") or "user").lower() == "user" else "Модель"
+
+
+def _brief(text: str, limit: int = 160) -> str:
+    text = " ".join((text or "").split())
+    first = _SENTENCE_END_RE.split(text, maxsplit=1)[0]
+    return first if len(first) <= limit else first[:limit].rstrip() + "…"
+
+
+def _trim_summary(summary: str, max_tokens: int) -> str:
+    """Drop the oldest summary lines until it fits in max_tokens."""
+    lines = summary.split("\n")
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+def summarize_turns(turns: list[dict], summary: str | None = None) -> str:
+    """Append a one-line gist of each turn to the rolling summary of older dialog."""
+    lines = [summary] if summary else []
+    lines += [f"{_role_name(msg)}: {_brief(msg.get('content'))}" for msg in turns]
+    return _trim_summary("\n".join(lines), Config.AI_HISTORY_SUMMARY_TOKENS)
+
+
+def fold_history(history: list[dict], summary: str | None = None) -> tuple[list[dict], str | None]:
+    """Bound the stored message_history.
+
+    Keeps the newest AI_HISTORY_MAX_MESSAGES messages (each cut to
+    AI_HISTORY_MAX_MESSAGE_CHARS) and folds older ones into the summary, so the
+    per-user FSM blob stops growing with the dialog.
+    """
+    limit = Config.AI_HISTORY_MAX_MESSAGE_CHARS
+    history = [
+        {**msg, "content": (msg.get("content") or "")[:limit]} if len(msg.get("content") or "") > limit else msg
+        for msg in history
+    ]
+    keep = Config.AI_HISTORY_MAX_MESSAGES
+    if len(history) <= keep:
+        return history, summary
+    return history[-keep:], summarize_turns(history[:-keep], summary)
+
+
+def select_history(history: list[dict], summary: str | None = None, budget: int | None = None) -> tuple[list[dict], str | None]:
+    """Pick the newest messages that fit in `budget` tokens for the prompt.
+
+    Messages that do not fit are folded into the summary for this prompt only.
+    The newest message is always kept.
+    """
+    budget = Config.AI_HISTORY_TOKEN_BUDGET if budget is None else budget
+    used = 0
+    start = len(history)
+    for i in range(len(history) - 1, -1, -1):
+        cost = estimate_tokens(history[i].get("content") or "") + 3
+        if used + cost > budget and start < len(history):
+            break
+        used += cost
+        start = i
+    if start:
+        summary = summarize_turns(history[:start], summary)
+    return history[start:], summary
@@ -0,0 +1,85 @@
+import random
+import time
+from collections import deque
+
+
+class LatencyTracker:
+    """Rolling window of successful call durations (seconds)."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def p95(self) -> float | None:
+        return self.percentile(0.95)
+
+
+class CircuitOpenError(Exception):
+    """Every model's breaker refused the call; raised at once instead of waiting on a broken model."""
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures, for `reset_seconds`.
+
+    Once the open period is over a single probe call is let through (half-open);
+    its outcome closes the breaker again or re-opens it. A probe that ends without
+    an outcome (cancelled, non-retryable error) must be given back with release();
+    one that is never resolved expires after `reset_seconds`.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probe_started: float | None = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self._probe_started = time.monotonic()
+            return True
+        return False
+
+    @property
+    def probing(self) -> bool:
+        return self._probe_started is not None and time.monotonic() - self._probe_started < self.reset_seconds
+
+    def release(self):
+        """End a probe without a verdict, so the next call may probe instead."""
+        self._probe_started = None
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._probe_started = None
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter for retry number `attempt` (1-based)."""
+    return random.uniform(0, min(cap, base * (2 ** (attempt - 1))))
@@ -2,10 +2,14 @@ from aiogram import Bot
 import traceback
 import logging
 import asyncio
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
+import threading
+from collections import OrderedDict, deque
+from aiogram.exceptions import TelegramRetryAfter
 
 from config import Config
+from utils.rate_limit import TokenBucket
+from utils.telegram_sender import PRIORITY_BACKGROUND, get_bot, set_priority
+from utils.tracing import detached_task
 
 main_bot = None
 _admin_bot: Bot | None = None
@@ -14,62 +18,177 @@ def _get_admin_bot() -> Bot | None:
     global _admin_bot
     if _admin_bot is None and Config.ADMIN_BOT_TOKEN:
         try:
-            # Use default HTML for normal messages, but we'll explicitly set parse_mode=None for logs.
-            _admin_bot = Bot(token=Config.ADMIN_BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-        except Exception:
-            _admin_bot = Bot(token=Config.ADMIN_BOT_TOKEN)
+            # Same Bot (and connection pool) as the admin bot itself when it runs in this process.
+            # Default is HTML for normal messages; logs explicitly set parse_mode=None.
+            _admin_bot = get_bot(Config.ADMIN_BOT_TOKEN)
+        except Exception as e:
+            logger.warning(f"[logging_utils] invalid ADMIN_BOT_TOKEN: {e}")
     return _admin_bot
 
 def set_main_bot(bot: Bot):
     global main_bot
     main_bot = bot
 
+# Records from this module are never shipped, so a failing delivery cannot feed itself
+logger = logging.getLogger(__name__)
+
+
+class LogShipper:
+    """Queue of admin log lines, delivered as one batched message per flush interval.
+
+    `submit` never blocks and is safe to call from any thread. Identical lines
+    within a batch are collapsed into one with a ×N counter; once `max_pending`
+    distinct lines are waiting, new ones are dropped and counted. Deliveries go
+    through a token bucket so an error storm cannot hit Telegram flood limits; a
+    message Telegram rate-limits anyway is kept and retried first on the next flush.
+    """
+
+    MAX_LEN = 3500
+
+    def __init__(self, flush_interval: float, max_pending: int, rate: float):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.bucket = TokenBucket(rate, capacity=max(1.0, rate * 3))
+        self.dropped = 0
+        self.sent = 0
+        self._pending: OrderedDict[str, int] = OrderedDict()
+        self._dropped_unreported = 0
+        # (chunk, admin ids still waiting for it), oldest first
+        self._retry: deque[tuple[str, list[int]]] = deque()
+        self._lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+
+    def submit(self, text: str):
+        with self._lock:
+            if text in self._pending:
+                self._pending[text] += 1
+            elif len(self._pending) < self.max_pending:
+                self._pending[text] = 1
+            else:
+                self.dropped += 1
+                self._dropped_unreported += 1
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = detached_task(self._run())
+
+    def _take_batch(self) -> list[str]:
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+            dropped, self._dropped_unreported = self._dropped_unreported, 0
+        lines = [text if count == 1 else f"{text} (×{count})" for text, count in pending.items()]
+        if dropped:
+            lines.append(f"…ещё {dropped} записей отброшено (очередь переполнена)")
+        return lines
+
+    def _chunks(self, lines: list[str]) -> list[str]:
+        chunks, current = [], ""
+        for line in lines:
+            if len(line) > self.MAX_LEN:
+                line = line[:self.MAX_LEN] + "\n…(truncated)"
+            if current and len(current) + len(line) + 2 > self.MAX_LEN:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n\n{line}" if current else line
+        if current:
+            chunks.append(current)
+        return chunks
+
+    async def flush(self):
+        queue = self._retry
+        queue.extend((chunk, list(Config.ADMIN_IDS)) for chunk in self._chunks(self._take_batch()))
+        while queue:
+            chunk, admin_ids = queue[0]
+            waiting = await _deliver(chunk, self.bucket, admin_ids)
+            if waiting:
+                # Rate limited: this chunk and everything after it waits for the next flush
+                queue[0] = (chunk, waiting)
+                break
+            queue.popleft()
+            self.sent += 1
+        # A long rate limit must not grow the backlog without bound: newest chunks go first
+        while len(queue) > self.max_pending:
+            queue.pop()
+            self.dropped += 1
+            self._dropped_unreported += 1
+
+    async def _run(self):
+        # Logs yield to user-facing replies when the Telegram rate limit is saturated
+        set_priority(PRIORITY_BACKGROUND)
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"LogShipper: flush failed: {e}")
+
+    async def close(self):
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            # Let a flush in progress stop before the final one starts
+            await asyncio.gather(task, return_exceptions=True)
+        await self.flush()
+
+
+log_shipper = LogShipper(
+    flush_interval=Config.ADMIN_LOG_FLUSH_SECONDS,
+    max_pending=Config.ADMIN_LOG_MAX_PENDING,
+    rate=Config.ADMIN_LOG_RATE_PER_SECOND,
+)
+
+
 class _AdminLogHandler(logging.Handler):
     def __init__(self, level=logging.WARNING):
         super().__init__(level=level)
 
     def emit(self, record: logging.LogRecord):
+        if record.name == logger.name:
+            return
         try:
-            msg = self.format(record)
-            asyncio.get_event_loop().create_task(send_log_to_admins(f"[log] {record.levelname}: {msg}"))
-        except Exception as e:
-            logging.warning(f"_AdminLogHandler.emit failed: {e}")
+            log_shipper.submit(f"[log] {record.levelname}: {self.format(record)}")
+        except Exception:
+            self.handleError(record)
 
 def setup_logging_bridge(level=logging.WARNING):
     root = logging.getLogger()
     if not any(isinstance(h, _AdminLogHandler) for h in root.handlers):
         handler = _AdminLogHandler(level=level)
-        formatter = logging.Formatter("%(asctime)s %(name)s: %(message)s")
+        # No timestamp: Telegram shows when the batch arrived, and identical lines must collapse
+        formatter = logging.Formatter("%(name)s: %(message)s")
         handler.setFormatter(formatter)
         root.addHandler(handler)
+    log_shipper.start()
 
 async def send_log_to_admins(text: str):
+    """Queue a message for the admins; it goes out with the next batch."""
+    log_shipper.submit(text)
+
+async def _deliver(text: str, bucket: TokenBucket, admin_ids: list[int]) -> list[int]:
+    """Send `text` to each of `admin_ids`; returns the ones to retry later because Telegram rate-limited us."""
     admin_bot = _get_admin_bot()
-    # Ensure arbitrary log text doesn't break Telegram parsing by disabling parse mode.
-    # Also trim extremely long logs to a reasonable size.
-    MAX_LEN = 3500
-    safe_text = text if len(text) <= MAX_LEN else (text[:MAX_LEN] + "\n…(truncated)")
-    if admin_bot:
-        if not Config.ADMIN_IDS:
-            logging.warning("[logging_utils] ADMIN_IDS пуст — некуда отправлять логи админ-ботом.")
-        for admin_id in Config.ADMIN_IDS:
-            try:
-                await admin_bot.send_message(admin_id, safe_text, parse_mode=None)
-            except Exception as e:
-                logging.error(f"Failed to send log via admin bot to {admin_id}: {e}")
-        return
-    if main_bot:
-        if not Config.ADMIN_IDS:
-            logging.warning("[logging_utils] ADMIN_IDS пуст — некуда отправлять логи основным ботом.")
-        for admin_id in Config.ADMIN_IDS:
-            try:
-                await main_bot.send_message(admin_id, safe_text, parse_mode=None)
-            except Exception as e:
-                logging.error(f"Failed to send log via main bot to {admin_id}: {e}")
-    else:
+    bot = admin_bot or main_bot
+    if bot is None:
         if not Config.ADMIN_BOT_TOKEN:
-            logging.warning("[logging_utils] ADMIN_BOT_TOKEN не задан — админ-бот для логов не активен.")
-        logging.warning("[logging_utils] main_bot не установлен — логи не могут быть отправлены.")
+            logger.warning("[logging_utils] ADMIN_BOT_TOKEN не задан — админ-бот для логов не активен.")
+        logger.warning("[logging_utils] main_bot не установлен — логи не могут быть отправлены.")
+        return []
+    if not admin_ids:
+        logger.warning("[logging_utils] ADMIN_IDS пуст — некуда отправлять логи.")
+        return []
+    via = "admin bot" if admin_bot else "main bot"
+    for i, admin_id in enumerate(admin_ids):
+        await bucket.acquire()
+        try:
+            # Arbitrary log text must not break Telegram parsing, so no parse mode.
+            await bot.send_message(admin_id, text, parse_mode=None)
+        except TelegramRetryAfter as e:
+            bucket.pause(e.retry_after)
+            logger.warning(f"Log delivery via {via} to {admin_id} rate limited for {e.retry_after}s, will retry")
+            return admin_ids[i:]
+        except Exception as e:
+            logger.error(f"Failed to send log via {via} to {admin_id}: {e}")
+    return []
 
 async def log_new_user(username: str, user_id: int):
     await send_log_to_admins(f"New user: {username} (ID: {user_id})")
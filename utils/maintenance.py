@@ -0,0 +1,65 @@
+import asyncio
+import logging
+from datetime import timedelta
+
+from config import Config
+from models.database import db
+
+# Only one replica reaps at a time
+_LOCK_ID = 0x72656170
+
+
+def _reap_targets() -> list[tuple[str, str, timedelta]]:
+    """(table, timestamp column, max age) for rows that are safe to drop once expired."""
+    return [
+        # Stripe Checkout sessions expire after 24h; the token is useless afterwards
+        ("checkout_sessions", "created_at", timedelta(hours=Config.CHECKOUT_SESSION_TTL_HOURS)),
+        ("active_messages", "updated_at", timedelta(days=Config.ACTIVE_MESSAGE_TTL_DAYS)),
+        # Already invisible to readers past their TTL
+        ("fsm_storage", "updated_at", timedelta(minutes=Config.SESSION_TIMEOUT_MINUTES)),
+        ("ai_response_cache", "created_at", timedelta(hours=Config.AI_CACHE_TTL_HOURS)),
+    ]
+
+
+async def _reap(conn, table: str, column: str, max_age: timedelta) -> int:
+    """Delete expired rows in batches of MAINTENANCE_BATCH_SIZE, each its own short transaction."""
+    total = 0
+    while True:
+        status = await conn.execute(
+            f"DELETE FROM {table} WHERE ctid = ANY(ARRAY("
+            f"SELECT ctid FROM {table} WHERE {column} < NOW() - $1::interval LIMIT $2))",
+            max_age, Config.MAINTENANCE_BATCH_SIZE,
+        )
+        deleted = int(status.split()[-1])
+        total += deleted
+        if deleted < Config.MAINTENANCE_BATCH_SIZE:
+            return total
+        # Let other writers in between batches
+        await asyncio.sleep(0.1)
+
+
+async def reap_expired_rows() -> dict[str, int] | None:
+    """One maintenance pass. Returns rows deleted per table, or None if another replica holds the lock."""
+    async with db.acquire("maintenance") as conn:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", _LOCK_ID):
+            return None
+        try:
+            reaped = {}
+            for table, column, max_age in _reap_targets():
+                reaped[table] = await _reap(conn, table, column, max_age)
+            return reaped
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", _LOCK_ID)
+
+
+async def run_maintenance():
+    """Background loop: reap expired rows every MAINTENANCE_INTERVAL_MINUTES."""
+    while True:
+        await asyncio.sleep(Config.MAINTENANCE_INTERVAL_MINUTES * 60)
+        try:
+            reaped = await reap_expired_rows()
+        except Exception as e:
+            logging.warning(f"Maintenance: reaping failed: {e}")
+            continue
+        if reaped is not None:
+            logging.info(f"Maintenance: reaped {sum(reaped.values())} rows: " + ", ".join(f"{t}={n}" for t, n in reaped.items()))
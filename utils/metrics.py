@@ -0,0 +1,153 @@
+import asyncio
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable
+
+# Seconds; covers fast DB calls up to slow LLM answers
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.labelnames)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self._samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        return [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Gauge read at scrape time from `callback`, which returns {label values tuple: value} or a number."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, callback: Callable, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.callback = callback
+
+    def _samples(self):
+        try:
+            values = self.callback()
+        except Exception:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in values.items() if v is not None]
+
+
+class CounterFunc(Gauge):
+    """Counter kept elsewhere (e.g. cache hit totals) and read at scrape time."""
+
+    kind = "counter"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # key -> [per-bucket counts..., +Inf count, sum]
+        self._values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block; an `outcome` label (ok/error/cancelled) is set if declared."""
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            if "outcome" in self.labelnames:
+                labels = {**labels, "outcome": outcome}
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        lines = []
+        for key, entry in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), entry[:-1]):
+                cumulative += count
+                le = 'le="' + _num(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_num(entry[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+REGISTRY: list[_Metric] = []
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    return "\n".join(m.render() for m in REGISTRY) + "\n"
+
+
+# Shared metrics; module-specific ones live next to the code they measure
+handler_duration = Histogram("bot_handler_duration_seconds", "Time spent in aiogram handlers", ("event", "handler", "outcome"))
+telegram_api_duration = Histogram("telegram_api_request_duration_seconds", "Bot API request latency", ("method", "outcome"))
+db_pool_wait = Histogram("db_pool_wait_seconds", "Time waiting for a connection from the asyncpg pool", (), buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+db_query_duration = Histogram("db_query_duration_seconds", "Time a Database method held its connection", ("method", "outcome"))
+gemini_duration = Histogram("gemini_request_duration_seconds", "Gemini generate_content latency", ("model", "outcome"))
+gemini_tokens = Counter("gemini_tokens_total", "Gemini tokens by kind (prompt, cached, output)", ("model", "kind"))
+ai_reading_duration = Histogram("ai_reading_duration_seconds", "End-to-end time to produce an AI answer", ("mode", "outcome"))
+ai_reading_tokens = Histogram("ai_reading_tokens", "Total Gemini tokens per generated answer", (), buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 12000))
+stripe_duration = Histogram("stripe_request_duration_seconds", "Stripe API call latency", ("call", "outcome"))
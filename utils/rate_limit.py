@@ -0,0 +1,85 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts of up to `capacity`.
+
+    Waiters are served in arrival order, so one busy caller cannot starve others.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens: float = 1.0) -> float:
+        """Seconds until `tokens` are available."""
+        self._refill()
+        return max(0.0, (tokens - self._tokens) / self.rate)
+
+    async def acquire(self, tokens: float = 1.0):
+        async with self._lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep(self.delay(tokens))
+
+    def pause(self, seconds: float):
+        """Drain the bucket for `seconds` (e.g. after a RetryAfter), delaying every waiter."""
+        self._refill()
+        self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+
+
+class PriorityRateLimiter:
+    """Token bucket whose waiters are served by priority (lower value first), FIFO within one.
+
+    Callers only queue when the bucket is empty; a single pump task then hands
+    out tokens as they refill.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.bucket = TokenBucket(rate, capacity)
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._pump: asyncio.Task | None = None
+
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, priority: int = 0):
+        if not self._waiters and self.bucket.try_acquire():
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run())
+        await fut
+
+    def pause(self, seconds: float):
+        self.bucket.pause(seconds)
+
+    async def _run(self):
+        while self._waiters:
+            fut = self._waiters[0][2]
+            if fut.done():
+                heapq.heappop(self._waiters)
+            elif self.bucket.try_acquire():
+                heapq.heappop(self._waiters)
+                fut.set_result(None)
+            else:
+                await asyncio.sleep(self.bucket.delay())
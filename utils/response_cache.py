@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import logging
+import random
+import re
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from config import Config
+from models.database import db
+
+_WORD_RE = re.compile(r"\w+")
+# Filler words that do not change what a short tarot question is about
+_FILLER_WORDS = {
+    "а", "и", "но", "ли", "же", "бы", "вот", "ну", "мне", "меня", "мой", "моя", "мое", "мои",
+    "я", "у", "в", "во", "на", "по", "о", "об", "про", "для", "с", "со", "к", "ко", "это",
+    "скажи", "подскажи", "пожалуйста", "карта", "карты",
+}
+
+
+def normalize_question(question: str) -> str:
+    words = _WORD_RE.findall((question or "").lower().replace("ё", "е"))
+    return " ".join(w for w in words if w not in _FILLER_WORDS)
+
+
+def response_cache_key(spread: str, card_names, question: str) -> str:
+    """Key on spread type, the set of cards (order-independent) and the normalized question.
+
+    Hashed so neither the question nor the cards are stored in plain text.
+    """
+    raw = "|".join([spread, ";".join(sorted(card_names)), normalize_question(question)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Bounded in-memory LRU of AI answers with an optional Postgres tier.
+
+    `reuse_ratio` is the share of lookups allowed to be served from cache; the rest
+    are reported as misses so the answer gets regenerated (and refreshed in cache),
+    which keeps repeated readings from all looking the same.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float, reuse_ratio: float, use_db: bool):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self.reuse_ratio = reuse_ratio
+        self.use_db = use_db
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._tasks: set[asyncio.Task] = set()
+
+    def _remember(self, key: str, text: str, expires_at: float):
+        self._entries[key] = (expires_at, text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: str) -> str | None:
+        if random.random() >= self.reuse_ratio:
+            self.bypassed += 1
+            return None
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] >= time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._entries[key]
+        if self.use_db:
+            try:
+                row = await db.get_cached_response(key, timedelta(seconds=self.ttl))
+            except Exception as e:
+                logging.warning(f"ResponseCache: DB lookup failed: {e}")
+                row = None
+            if row is not None:
+                remaining = self.ttl - row['age_seconds']
+                self._remember(key, row['response'], time.monotonic() + remaining)
+                self.hits += 1
+                return row['response']
+        self.misses += 1
+        return None
+
+    def put(self, key: str, text: str):
+        """Store an answer; the DB write runs in the background."""
+        if not text:
+            return
+        self._remember(key, text, time.monotonic() + self.ttl)
+        if self.use_db:
+            task = asyncio.create_task(self._store(key, text))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _store(self, key: str, text: str):
+        try:
+            await db.put_cached_response(key, text)
+        except Exception as e:
+            logging.warning(f"ResponseCache: DB store failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+        }
+
+
+response_cache = ResponseCache(
+    max_size=Config.AI_CACHE_MAX_SIZE,
+    ttl_seconds=Config.AI_CACHE_TTL_HOURS * 3600,
+    reuse_ratio=Config.AI_CACHE_REUSE_RATIO,
+    use_db=Config.AI_CACHE_DB,
+)
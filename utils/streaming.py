@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import re
+import time
+
+from aiogram import types
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from config import Config
+
+# Telegram rejects texts longer than 4096 chars; intermediate frames above this are skipped.
+_MAX_FRAME_LEN = 4000
+_CURSOR = " …"
+
+# chat_id -> monotonic time of the last streamed edit in that chat
+_last_edit_at: dict[int, float] = {}
+
+
+async def _wait_edit_slot(chat_id: int):
+    """Sleep until the next edit in this chat is allowed by STREAM_EDIT_INTERVAL_SECONDS."""
+    now = time.monotonic()
+    ready_at = _last_edit_at.get(chat_id, 0.0) + Config.STREAM_EDIT_INTERVAL_SECONDS
+    if ready_at > now:
+        await asyncio.sleep(ready_at - now)
+    _last_edit_at[chat_id] = time.monotonic()
+    if len(_last_edit_at) > 10000:
+        cutoff = time.monotonic() - 60
+        for cid in [c for c, ts in _last_edit_at.items() if ts < cutoff]:
+            _last_edit_at.pop(cid, None)
+
+
+class IncrementalRenderer:
+    """Re-renders only the unfinished tail of a growing markdown text.
+
+    Paragraphs closed by a blank line never change while the answer streams in, so
+    their HTML is cached and only the last paragraph is converted on every frame.
+    """
+
+    def __init__(self, render):
+        self._render = render
+        self._prefix = ""
+        self._prefix_html = ""
+
+    def __call__(self, text: str) -> str:
+        cut = text.rfind("\n\n")
+        if cut != -1:
+            cut += 2
+            while cut < len(text) and text[cut] == "\n":
+                cut += 1
+            prefix = text[:cut]
+            if prefix != self._prefix:
+                self._prefix = prefix
+                self._prefix_html = self._render(prefix)
+        else:
+            self._prefix = ""
+            self._prefix_html = ""
+        html = self._prefix_html + (self._render(text[len(self._prefix):]) or "")
+        return re.sub(r"\n{3,}", "\n\n", html)
+
+
+class StreamingEditor:
+    """Progressively edits a placeholder message while an AI answer is streaming.
+
+    push() is cheap and never blocks: it only records the latest text and makes sure
+    a background task is editing the message. Edits are spaced per chat so we stay
+    under Telegram's edit rate; intermediate frames are simply skipped.
+    """
+
+    def __init__(self, message: types.Message, render=None):
+        self.message = message
+        self._render = render or (lambda s: s)
+        self._pending: str | None = None
+        self._shown: str | None = None
+        self._task: asyncio.Task | None = None
+
+    def push(self, text: str):
+        self._pending = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        while self._pending is not None:
+            await _wait_edit_slot(self.message.chat.id)
+            text, self._pending = self._pending, None
+            html = self._render(text)
+            if not html or len(html) > _MAX_FRAME_LEN or html == self._shown:
+                continue
+            try:
+                await self.message.edit_text(html + _CURSOR, parse_mode=ParseMode.HTML)
+                self._shown = html
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e).lower():
+                    logging.debug(f"Streaming edit failed for message {self.message.message_id}: {e}")
+            except Exception as e:
+                logging.debug(f"Streaming edit failed for message {self.message.message_id}: {e}")
+
+    async def cancel(self):
+        self._pending = None
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._task = None
+
+    async def finish(self, html: str, reply_markup=None) -> types.Message:
+        """Stop streaming and put the final text (already rendered) into the message.
+
+        Returns the message that holds the answer: the placeholder, or a new message
+        if the final edit was rejected.
+        """
+        await self.cancel()
+        for attempt in range(2):
+            await _wait_edit_slot(self.message.chat.id)
+            try:
+                await self.message.edit_text(html, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+                return self.message
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e).lower():
+                    return self.message
+                logging.debug(f"Final streaming edit failed for message {self.message.message_id}: {e}")
+                break
+            except Exception as e:
+                logging.debug(f"Final streaming edit failed for message {self.message.message_id}: {e}")
+                break
+        sent = await self.message.answer(html, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        try:
+            await self.message.delete()
+        except Exception as e:
+            logging.debug(f"Failed to delete streaming placeholder {self.message.message_id}: {e}")
+        return sent
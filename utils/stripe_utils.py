@@ -1,11 +1,39 @@
 import stripe
+import asyncio
+import functools
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from config import Config
+from utils.metrics import stripe_duration
+from utils.tracing import span
 
 stripe.api_key = Config.STRIPE_SECRET_KEY
+stripe.max_network_retries = Config.STRIPE_MAX_NETWORK_RETRIES
 
-def create_checkout_session(user_id, package, chat_id, message_id: int | None = None):
+# The Stripe SDK is synchronous, so every call runs on this dedicated pool instead of
+# the event loop. The pool size doubles as the concurrency cap, and RequestsClient
+# keeps one keep-alive session per pool thread, so connections are reused.
+_executor = ThreadPoolExecutor(max_workers=Config.STRIPE_MAX_CONCURRENCY, thread_name_prefix="stripe")
+try:
+    _requests_client_cls = getattr(stripe, "RequestsClient", None) or stripe.http_client.RequestsClient
+    stripe.default_http_client = _requests_client_cls(timeout=Config.STRIPE_TIMEOUT_SECONDS)
+except Exception as e:
+    logging.warning(f"Stripe: failed to configure HTTP client timeout, using SDK defaults: {e}")
+
+
+async def _run(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    call = getattr(fn, "__qualname__", repr(fn))
+    with span(f"stripe.{call}"), stripe_duration.time(call=call):
+        return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def retrieve_checkout_session(session_id: str):
+    return await _run(stripe.checkout.Session.retrieve, session_id)
+
+
+async def create_checkout_session(user_id, package, chat_id, message_id: int | None = None):
     packages = {
         "probe": {"crystals": Config.CRYSTALS_PROBE, "price": Config.PRICE_PROBE_CENTS},
         "standard": {"crystals": Config.CRYSTALS_STANDARD, "price": Config.PRICE_STANDARD_CENTS},
@@ -22,7 +50,8 @@ def create_checkout_session(user_id, package, chat_id, message_id: int | None =
         path = "/" + path
     base_url = f"{base}{path}"
     try:
-        session = stripe.checkout.Session.create(
+        session = await _run(
+            stripe.checkout.Session.create,
             payment_method_types=['card'],
             line_items=[{
                 'price_data': {
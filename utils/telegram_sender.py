@@ -0,0 +1,148 @@
+import contextvars
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+from config import Config
+from utils.metrics import CounterFunc, Gauge, telegram_api_duration
+from utils.tracing import span
+from utils.rate_limit import PriorityRateLimiter, TokenBucket
+
+# Priority lanes: lower goes first when the global limit is saturated
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_BULK = 2
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("telegram_priority", default=PRIORITY_INTERACTIVE)
+
+
+def set_priority(priority: int):
+    """Lane for every request sent from the current task from now on (e.g. a broadcast loop)."""
+    _priority.set(priority)
+
+
+@contextmanager
+def send_priority(priority: int):
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Outbound throttling shared by every bot on the session.
+
+    Requests addressed to a chat wait for that chat's bucket and then for the
+    bot's global bucket, where waiters are served by priority lane. Other methods
+    (getUpdates, answerCallbackQuery, setWebhook…) pass straight through.
+
+    RetryAfter pauses the chat's bucket, and also the bot's global limiter when
+    the flood is bot-wide: for methods without a chat, and for private chats,
+    whose own limit the chat bucket already respects. Chat-addressed requests are
+    then retried, as long as the wait stays under TELEGRAM_MAX_RETRY_AFTER_SECONDS.
+    """
+
+    def __init__(self):
+        self._global: dict[int, PriorityRateLimiter] = {}
+        self._chats: OrderedDict[tuple[int, int | str], TokenBucket] = OrderedDict()
+        self.retried = 0
+        # bot id -> monotonic time of the last successful getUpdates (readiness probe)
+        self.last_poll: dict[int, float] = {}
+
+    def _global_limiter(self, bot: Bot) -> PriorityRateLimiter:
+        limiter = self._global.get(bot.id)
+        if limiter is None:
+            limiter = self._global[bot.id] = PriorityRateLimiter(Config.TELEGRAM_GLOBAL_RATE, Config.TELEGRAM_GLOBAL_RATE)
+        return limiter
+
+    def _chat_bucket(self, bot: Bot, chat_id) -> TokenBucket:
+        key = (bot.id, chat_id)
+        bucket = self._chats.get(key)
+        if bucket is None:
+            bucket = self._chats[key] = TokenBucket(Config.TELEGRAM_CHAT_RATE, Config.TELEGRAM_CHAT_BURST)
+            while len(self._chats) > 50000:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(key)
+        return bucket
+
+    def seconds_since_poll(self, bot_id: int) -> float | None:
+        last = self.last_poll.get(bot_id)
+        return None if last is None else time.monotonic() - last
+
+    async def _send(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        name = type(method).__name__
+        with span(f"telegram.{name}"), telegram_api_duration.time(method=name):
+            result = await make_request(bot, method)
+        if name == "GetUpdates":
+            self.last_poll[bot.id] = time.monotonic()
+        return result
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            try:
+                return await self._send(make_request, bot, method)
+            except TelegramRetryAfter as e:
+                self._global_limiter(bot).pause(e.retry_after)
+                raise
+        # Groups and channels have far lower per-chat limits; a flood there says nothing about the bot
+        bot_wide = isinstance(chat_id, int) and chat_id > 0
+        chat_bucket = self._chat_bucket(bot, chat_id)
+        limiter = self._global_limiter(bot)
+        attempt = 0
+        while True:
+            await chat_bucket.acquire()
+            await limiter.acquire(_priority.get())
+            try:
+                return await self._send(make_request, bot, method)
+            except TelegramRetryAfter as e:
+                chat_bucket.pause(e.retry_after)
+                if bot_wide:
+                    limiter.pause(e.retry_after)
+                attempt += 1
+                if attempt > Config.TELEGRAM_MAX_RETRIES or e.retry_after > Config.TELEGRAM_MAX_RETRY_AFTER_SECONDS:
+                    raise
+                self.retried += 1
+                logging.warning(f"Telegram RetryAfter {e.retry_after}s on {type(method).__name__} to {chat_id}, retrying")
+
+
+rate_limiter = RateLimitMiddleware()
+Gauge("telegram_send_queue", "Requests waiting for the per-bot global rate limit",
+      lambda: {(str(bot_id),): limiter.waiting() for bot_id, limiter in rate_limiter._global.items()}, ("bot",))
+CounterFunc("telegram_retry_after_total", "Requests retried after a RetryAfter", lambda: rate_limiter.retried)
+_session: AiohttpSession | None = None
+_bots: dict[str, Bot] = {}
+
+
+def shared_session() -> AiohttpSession:
+    """One connection pool (and one set of rate limits) for every Bot in the process."""
+    global _session
+    if _session is None:
+        api = TelegramAPIServer.from_base(Config.TELEGRAM_API_URL) if Config.TELEGRAM_API_URL else None
+        _session = AiohttpSession(limit=Config.TELEGRAM_POOL_SIZE, **({"api": api} if api else {}))
+        _session.middleware(rate_limiter)
+    return _session
+
+
+def get_bot(token: str) -> Bot:
+    """The process-wide Bot for `token`, created on the shared session."""
+    bot = _bots.get(token)
+    if bot is None:
+        bot = _bots[token] = Bot(token=token, session=shared_session(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    return bot
+
+
+async def close_shared_session():
+    if _session is not None:
+        await _session.close()
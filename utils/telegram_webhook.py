@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from config import Config
+from utils.metrics import CounterFunc, Gauge
+
+
+def webhook_secret() -> str:
+    """Secret Telegram echoes in X-Telegram-Bot-Api-Secret-Token.
+
+    Derived from the bot token when TELEGRAM_WEBHOOK_SECRET is not set, so every
+    replica computes the same value without extra configuration.
+    """
+    if Config.TELEGRAM_WEBHOOK_SECRET:
+        return Config.TELEGRAM_WEBHOOK_SECRET
+    return hashlib.sha256(f"telegram-webhook:{Config.BOT_TOKEN}".encode()).hexdigest()
+
+
+def webhook_url() -> str:
+    base = (Config.PUBLIC_BASE_URL or "http://localhost:8000").rstrip("/")
+    path = (Config.PUBLIC_BASE_PATH or "").strip()
+    if path and not path.startswith("/"):
+        path = "/" + path
+    return f"{base}{path}{Config.TELEGRAM_WEBHOOK_PATH}"
+
+
+class TelegramWebhookIngress:
+    """Accepts Telegram updates over HTTP and feeds them to the dispatcher.
+
+    The HTTP handler only checks the secret and enqueues the payload, so Telegram
+    gets its 200 right away. A fixed number of workers drain the queue; when it is
+    full we answer 503 and Telegram redelivers the update later.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int, queue_size: int):
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.rejected = 0
+        self._secret = webhook_secret()
+        self._tasks: list[asyncio.Task] = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, self._secret):
+            return web.Response(status=401)
+        try:
+            payload = await request.json()
+        except Exception:
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logging.warning(f"Telegram webhook: queue full ({self.queue.qsize()}), asking Telegram to retry")
+            return web.Response(status=503)
+        return web.Response(status=200)
+
+    def alive(self) -> bool:
+        """True once the workers are running and none of them has died."""
+        return bool(self._tasks) and not any(task.done() for task in self._tasks)
+
+    async def _worker(self):
+        while True:
+            payload = await self.queue.get()
+            try:
+                update = Update.model_validate(payload, context={"bot": self.bot})
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logging.exception(f"Telegram webhook: failed to process update {payload.get('update_id')}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def on_startup(self, app: web.Application):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def on_cleanup(self, app: web.Application):
+        await self.stop()
+
+    async def stop(self):
+        """Drain the queue (up to 10s) and stop the workers; safe to call more than once."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=10)
+        except asyncio.TimeoutError:
+            logging.warning(f"Telegram webhook: {self.queue.qsize()} updates left unprocessed on shutdown")
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def setup(self, app: web.Application, path: str):
+        app.router.add_post(path, self.handle)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+
+
+_ingress: TelegramWebhookIngress | None = None
+Gauge("telegram_webhook_queue_depth", "Webhook updates waiting for a worker", lambda: _ingress.queue.qsize() if _ingress else None)
+CounterFunc("telegram_webhook_rejected_total", "Webhook updates answered 503 because the queue was full",
+            lambda: _ingress.rejected if _ingress else None)
+
+
+def setup_telegram_webhook(app: web.Application, dp: Dispatcher, bot: Bot) -> TelegramWebhookIngress:
+    ingress = TelegramWebhookIngress(
+        dp, bot,
+        workers=Config.TELEGRAM_WEBHOOK_WORKERS,
+        queue_size=Config.TELEGRAM_WEBHOOK_QUEUE_SIZE,
+    )
+    ingress.setup(app, Config.TELEGRAM_WEBHOOK_PATH)
+    global _ingress
+    _ingress = ingress
+    return ingress
+
+
+async def serve_webhook(dp: Dispatcher, bot: Bot):
+    """Webhook-mode counterpart of dp.start_polling: registers the webhook and runs until cancelled.
+
+    The aiohttp app must already be started with setup_telegram_webhook mounted.
+    """
+    workflow_data = {**dp.workflow_data, "bot": bot, "bots": [bot], "dispatcher": dp}
+    await dp.emit_startup(**workflow_data)
+    try:
+        await bot.set_webhook(
+            url=webhook_url(),
+            secret_token=webhook_secret(),
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logging.info(f"Telegram webhook set to {webhook_url()}")
+        await asyncio.Event().wait()
+    finally:
+        # Finish queued updates before the shutdown hooks flush their buffers;
+        # the shared session is closed by the entrypoint
+        if _ingress is not None:
+            await _ingress.stop()
+        await dp.emit_shutdown(**workflow_data)
@@ -0,0 +1,287 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+
+import aiohttp
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+# Slow-update breakdowns are long and frequent under load: INFO on their own logger,
+# below the admin log bridge, so operators can route or silence them separately
+slow_logger = logging.getLogger(f"{__name__}.slow")
+
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start", "end", "attributes", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: str | None, attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.end: float | None = None
+        self.attributes = attributes
+        self.error: str | None = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Trace:
+    """All spans of one update. Spans are always collected; `sampled` only decides export."""
+
+    def __init__(self, sampled: bool):
+        self.trace_id = os.urandom(16).hex()
+        self.sampled = sampled
+        self.spans: list[Span] = []
+        self.truncated = 0
+        self.finished = False
+
+
+_current: contextvars.ContextVar[Span | None] = contextvars.ContextVar("trace_span", default=None)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Child span of the current one; a no-op outside a traced update (or with TRACING=0)."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    trace = parent.trace
+    if trace.finished:
+        # background task started during the update and outliving it
+        yield None
+        return
+    if len(trace.spans) >= Config.TRACE_MAX_SPANS:
+        trace.truncated += 1
+        yield None
+        return
+    current = Span(trace, name, parent.span_id, attributes)
+    trace.spans.append(current)
+    token = _current.set(current)
+    try:
+        yield current
+    except asyncio.CancelledError:
+        current.error = "cancelled"
+        raise
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end = time.time()
+        _current.reset(token)
+
+
+@contextmanager
+def root_span(name: str, **attributes):
+    """Start a trace (one per update); exported if sampled, logged if slower than TRACE_SLOW_UPDATE_SECONDS."""
+    if not Config.TRACING or _current.get() is not None:
+        with span(name, **attributes) as current:
+            yield current
+        return
+    trace = Trace(sampled=random.random() < Config.TRACE_SAMPLE_RATE)
+    root = Span(trace, name, None, attributes)
+    trace.spans.append(root)
+    token = _current.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.error = "cancelled" if isinstance(e, asyncio.CancelledError) else f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        root.end = time.time()
+        trace.finished = True
+        _current.reset(token)
+        _finish(trace, root)
+
+
+def detached_task(coro) -> asyncio.Task:
+    """Start a background task outside the current trace.
+
+    Tasks copy the context they are created in, so a long-lived loop started
+    from inside an update would otherwise file its spans under that update.
+    """
+    return asyncio.get_running_loop().create_task(coro, context=contextvars.Context())
+
+
+def traced(name: str):
+    """Decorator running a sync or async function inside a child span."""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _finish(trace: Trace, root: Span):
+    if root.duration >= Config.TRACE_SLOW_UPDATE_SECONDS:
+        slow_logger.info(f"Slow update ({root.duration:.2f}s):\n{format_trace(trace)}")
+    if trace.sampled:
+        exporter.submit(trace)
+
+
+def format_trace(trace: Trace) -> str:
+    """Indented span tree with offsets from the root start, for logs."""
+    root = trace.spans[0]
+    children: dict[str | None, list[Span]] = {}
+    for s in trace.spans[1:]:
+        children.setdefault(s.parent_id, []).append(s)
+    lines = []
+
+    def walk(s: Span, depth: int):
+        attrs = " ".join(f"{k}={v}" for k, v in s.attributes.items())
+        error = f" ERROR {s.error}" if s.error else ""
+        lines.append(f"{'  ' * depth}+{(s.start - root.start) * 1000:.0f}ms {s.name} {s.duration * 1000:.0f}ms {attrs}{error}".rstrip())
+        for child in children.get(s.span_id, []):
+            walk(child, depth + 1)
+
+    walk(root, 0)
+    if trace.truncated:
+        lines.append(f"…{trace.truncated} more spans not recorded")
+    return "\n".join(lines)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(trace: Trace, s: Span) -> dict:
+    out = {
+        "traceId": trace.trace_id,
+        "spanId": s.span_id,
+        "name": s.name,
+        "kind": 2 if s.parent_id is None else 1,
+        "startTimeUnixNano": str(int(s.start * 1e9)),
+        "endTimeUnixNano": str(int((s.end or s.start) * 1e9)),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attributes.items()],
+        "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+    }
+    if s.parent_id:
+        out["parentSpanId"] = s.parent_id
+    return out
+
+
+def _jsonl_record(trace: Trace) -> str:
+    return json.dumps({
+        "trace_id": trace.trace_id,
+        "spans": [
+            {
+                "span_id": s.span_id,
+                "parent_id": s.parent_id,
+                "name": s.name,
+                "start": s.start,
+                "duration_ms": round(s.duration * 1000, 3),
+                "attributes": s.attributes,
+                "error": s.error,
+            }
+            for s in trace.spans
+        ],
+    }, ensure_ascii=False, default=str)
+
+
+class TraceExporter:
+    """Batches sampled traces and writes them every few seconds.
+
+    Targets: TRACE_EXPORT_PATH (one JSON trace per line) and/or
+    TRACE_OTLP_ENDPOINT (OTLP/HTTP JSON, e.g. http://collector:4318/v1/traces).
+    At most `max_pending` traces are buffered; extra ones are dropped and counted.
+    """
+
+    def __init__(self, flush_interval: float = 5.0, max_pending: int = 1000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending: list[Trace] = []
+        self._task: asyncio.Task | None = None
+        self._session: aiohttp.ClientSession | None = None
+
+    def submit(self, trace: Trace):
+        if not (Config.TRACE_EXPORT_PATH or Config.TRACE_OTLP_ENDPOINT):
+            return
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending.append(trace)
+        if self._task is None or self._task.done():
+            self._task = detached_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        if Config.TRACE_EXPORT_PATH:
+            try:
+                await asyncio.to_thread(self._write_jsonl, batch)
+            except Exception as e:
+                logger.warning(f"Tracing: failed to write {len(batch)} traces to {Config.TRACE_EXPORT_PATH}: {e}")
+        if Config.TRACE_OTLP_ENDPOINT:
+            await self._post_otlp(batch)
+
+    @staticmethod
+    def _write_jsonl(batch: list[Trace]):
+        with open(Config.TRACE_EXPORT_PATH, "a", encoding="utf-8") as f:
+            f.write("".join(_jsonl_record(t) + "\n" for t in batch))
+
+    async def _post_otlp(self, batch: list[Trace]):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": Config.TRACE_SERVICE_NAME}}]},
+                "scopeSpans": [{
+                    "scope": {"name": __name__},
+                    "spans": [_otlp_span(t, s) for t in batch for s in t.spans],
+                }],
+            }],
+        }
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        try:
+            async with self._session.post(Config.TRACE_OTLP_ENDPOINT, json=payload) as resp:
+                if resp.status >= 300:
+                    logger.warning(f"Tracing: OTLP collector answered {resp.status} for {len(batch)} traces")
+        except Exception as e:
+            logger.warning(f"Tracing: failed to export {len(batch)} traces: {e}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        if self._session is not None:
+            await self._session.close()
+
+
+exporter = TraceExporter()
@@ -1,5 +1,5 @@
 from aiogram import types
-from models.database import db
+from utils.active_messages import active_messages
 from config import Config
 import logging
 
@@ -81,14 +81,8 @@ def help_menu_kb() -> types.InlineKeyboardMarkup:
 
 
 async def set_active_kb(message: types.Message):
+    """Mark `message` as the one with the live keyboard; the previous keyboard is cleared in the background."""
     try:
-        user_id = message.chat.id  
-        prev_id = await db.get_active_message_id(user_id)
-        if prev_id and prev_id != message.message_id:
-            try:
-                await message.bot.edit_message_reply_markup(chat_id=message.chat.id, message_id=prev_id, reply_markup=None)
-            except Exception as e:
-                logging.debug(f"Failed to clear previous inline keyboard for user {user_id}: {e}")
-        await db.set_active_message_id(user_id, message.message_id)
+        active_messages.activate(message.bot, message.chat.id, message.message_id)
     except Exception as e:
         logging.warning(f"set_active_kb failed for message {getattr(message, 'message_id', None)}: {e}")